@@ -1,18 +1,23 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify
+import itertools
+import math
+import re
 import requests
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import json
+import atexit
 import sqlite3
+from collections import OrderedDict
 from contextlib import closing
 import os
 import hashlib
+import uuid
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import numpy as np
 import pandas as pd
-try:
-    import ta
-    TALIB_AVAILABLE = True
-except ImportError:
-    TALIB_AVAILABLE = False
-    print("Warning: ta library not installed. Technical indicators will not be available.")
+from indicators import DEFAULT_PARAMS, IndicatorState, compute_indicators
 
 # AI API 支持
 try:
@@ -36,6 +41,13 @@ except ImportError:
     OLLAMA_AVAILABLE = False
     print("Warning: ollama library not installed.")
 
+# 選用：精確計算 OpenAI 提示詞 token 數，未安裝時改用估算
+try:
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    TIKTOKEN_AVAILABLE = False
+
 from bs4 import BeautifulSoup
 import time
 
@@ -57,6 +69,13 @@ if DB_IS_PG:
     except Exception as e:
         raise RuntimeError(f"PostgreSQL support requires psycopg: {e}")
 
+    try:
+        from psycopg_pool import ConnectionPool
+        PG_POOL_AVAILABLE = True
+    except ImportError:
+        PG_POOL_AVAILABLE = False
+        print("Warning: psycopg_pool not installed. Database connections will not be pooled.")
+
 app = Flask(__name__)
 
 # 初始化 AI 服務
@@ -84,13 +103,158 @@ def q(sql: str) -> str:
     return sql
 
 
+# ========== 資料庫連線池 ==========
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', '1'))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '10'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '30'))
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+
+
+class PoolMetrics:
+    """連線借出次數與等待時間統計"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait):
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'avg_checkout_ms': round(self.total_wait / self.checkouts * 1000, 3) if self.checkouts else 0.0,
+                'max_checkout_ms': round(self.max_wait * 1000, 3)
+            }
+
+
+class SqlitePool:
+    """
+    SQLite 連線池：連線建立一次後重複使用（WAL 模式與調整過的 pragma）
+    同一時間一條連線只借給一個執行緒，巢狀呼叫會拿到另一條連線
+    """
+
+    def __init__(self, path, max_idle):
+        self.path = path
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+        self.created = 0
+        self.in_use = 0
+
+    def _connect(self):
+        # 确保 data 目录存在
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}')
+        conn.execute('PRAGMA cache_size=-16000')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+
+    def getconn(self):
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+            self.in_use += 1
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._lock:
+                    self.in_use -= 1
+                raise
+            with self._lock:
+                self.created += 1
+        return conn
+
+    def putconn(self, conn):
+        # 歸還前撤銷未提交的交易並還原 row_factory，避免狀態帶到下一次借用
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            conn.row_factory = None
+            reusable = True
+        except sqlite3.Error:
+            reusable = False
+        with self._lock:
+            self.in_use -= 1
+            if reusable and len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+            self.created -= 1
+        conn.close()
+
+    def get_stats(self):
+        with self._lock:
+            return {'pool_size': self.created, 'pool_available': len(self._idle), 'in_use': self.in_use}
+
+
+class PooledConnection:
+    """借出的連線；close() 時歸還連線池而非真正關閉，其餘屬性轉給原連線"""
+
+    def __init__(self, pool, conn):
+        object.__setattr__(self, '_pool', pool)
+        object.__setattr__(self, '_conn', conn)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+    def close(self):
+        conn = self._conn
+        if conn is None:
+            return
+        object.__setattr__(self, '_conn', None)
+        # 唯讀路徑不會 commit；PostgreSQL 歸還前先結束交易，避免 psycopg_pool 警告並多一次 rollback
+        if DB_IS_PG and conn.info.transaction_status != psycopg.pq.TransactionStatus.IDLE:
+            try:
+                conn.rollback()
+            except psycopg.Error:
+                pass  # 連線已損壞時由連線池丟棄
+        self._pool.putconn(conn)
+
+
+db_pool_metrics = PoolMetrics()
+if DB_IS_PG:
+    db_pool = ConnectionPool(
+        DB_URL,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        timeout=DB_POOL_TIMEOUT,
+        name='pecunia',
+        open=True
+    ) if PG_POOL_AVAILABLE else None
+else:
+    db_pool = SqlitePool(SQLITE_DB_PATH, DB_POOL_MAX_SIZE)
+
+
 def get_conn():
-    if DB_IS_PG:
+    """從連線池借出連線；以 closing() 包裝使用，結束時自動歸還"""
+    if DB_IS_PG and db_pool is None:
         return psycopg.connect(DB_URL)
-    else:
-        # 确保 data 目录存在
-        os.makedirs(os.path.dirname(SQLITE_DB_PATH), exist_ok=True)
-        return sqlite3.connect(SQLITE_DB_PATH)
+    started = time.perf_counter()
+    conn = db_pool.getconn()
+    db_pool_metrics.record(time.perf_counter() - started)
+    return PooledConnection(db_pool, conn)
+
+
+def db_pool_stats():
+    """連線池狀態（大小、閒置數、等待與借出耗時）"""
+    stats = {'backend': 'postgresql' if DB_IS_PG else 'sqlite', 'pooled': db_pool is not None}
+    if db_pool is not None:
+        stats.update(db_pool.get_stats())
+        stats['max_size'] = DB_POOL_MAX_SIZE
+    stats.update(db_pool_metrics.stats())
+    return stats
 
 
 def hash_password(password: str) -> str:
@@ -98,355 +262,1874 @@ def hash_password(password: str) -> str:
     return hashlib.sha256(password.encode('utf-8')).hexdigest()
 
 
-def check_user_is_admin(user_id: str) -> bool:
-    """檢查使用者是否為管理員"""
+def check_user_is_admin(user_id: str, conn=None) -> bool:
+    """檢查使用者是否為管理員；可傳入呼叫端已借出的連線以免再借一條"""
     try:
-        with closing(get_conn()) as conn:
-            if not DB_IS_PG:
-                conn.row_factory = sqlite3.Row
-            with closing(conn.cursor(row_factory=dict_row) if DB_IS_PG else conn.cursor()) as cursor:
-                cursor.execute(q('SELECT is_admin FROM users WHERE user_id = ?'), (user_id,))
-                row = cursor.fetchone()
-                if not row:
-                    return False
-                if DB_IS_PG:
-                    return row.get('is_admin', False)
-                else:
-                    return bool(row['is_admin'])
+        return UsersRepo.is_admin(user_id, conn)
     except Exception:
         return False
 
 
+# ========== 資料庫結構遷移 ==========
+def _migration_base_tables(cursor):
+    """v1：基本資料表"""
+    if DB_IS_PG:
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS watchlist (
+                id SERIAL PRIMARY KEY,
+                stock_code TEXT NOT NULL,
+                stock_name TEXT,
+                category TEXT NOT NULL,
+                added_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS search_history (
+                id SERIAL PRIMARY KEY,
+                stock_code TEXT NOT NULL,
+                stock_name TEXT,
+                search_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS favorites (
+                id SERIAL PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                stock_code TEXT NOT NULL,
+                stock_name TEXT,
+                liked_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        cursor.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_fav_user_time ON favorites(user_id, liked_time)
+            """
+        )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                id SERIAL PRIMARY KEY,
+                user_id TEXT NOT NULL UNIQUE,
+                password_hash TEXT NOT NULL,
+                is_admin BOOLEAN DEFAULT FALSE,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS app_config (
+                config_key TEXT PRIMARY KEY,
+                config_value TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS daily_bars (
+                stock_code TEXT NOT NULL,
+                trade_date TEXT NOT NULL,
+                open DOUBLE PRECISION,
+                high DOUBLE PRECISION,
+                low DOUBLE PRECISION,
+                close DOUBLE PRECISION,
+                volume DOUBLE PRECISION,
+                raw_row TEXT NOT NULL,
+                PRIMARY KEY (stock_code, trade_date)
+            )
+            """
+        )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS bar_months (
+                stock_code TEXT NOT NULL,
+                month TEXT NOT NULL,
+                fetched_at DOUBLE PRECISION NOT NULL,
+                PRIMARY KEY (stock_code, month)
+            )
+            """
+        )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS indicator_state (
+                stock_code TEXT NOT NULL,
+                state_key TEXT NOT NULL,
+                last_date TEXT NOT NULL,
+                state TEXT NOT NULL,
+                updated_at DOUBLE PRECISION NOT NULL,
+                PRIMARY KEY (stock_code, state_key)
+            )
+            """
+        )
+    else:
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS watchlist (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                stock_code TEXT NOT NULL,
+                stock_name TEXT,
+                category TEXT NOT NULL,
+                added_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS search_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                stock_code TEXT NOT NULL,
+                stock_name TEXT,
+                search_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS favorites (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                stock_code TEXT NOT NULL,
+                stock_name TEXT,
+                liked_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        cursor.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_fav_user_time ON favorites(user_id, liked_time)
+            """
+        )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL UNIQUE,
+                password_hash TEXT NOT NULL,
+                is_admin INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS app_config (
+                config_key TEXT PRIMARY KEY,
+                config_value TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS daily_bars (
+                stock_code TEXT NOT NULL,
+                trade_date TEXT NOT NULL,
+                open REAL,
+                high REAL,
+                low REAL,
+                close REAL,
+                volume REAL,
+                raw_row TEXT NOT NULL,
+                PRIMARY KEY (stock_code, trade_date)
+            )
+            """
+        )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS bar_months (
+                stock_code TEXT NOT NULL,
+                month TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                PRIMARY KEY (stock_code, month)
+            )
+            """
+        )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS indicator_state (
+                stock_code TEXT NOT NULL,
+                state_key TEXT NOT NULL,
+                last_date TEXT NOT NULL,
+                state TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (stock_code, state_key)
+            )
+            """
+        )
+
+
+def _migration_query_indexes(cursor):
+    """v2：依實際查詢建立索引，最愛清單 (user_id, stock_code) 唯一"""
+    # 先清除重複的最愛，只保留最新加入的一筆
+    cursor.execute(
+        """
+        DELETE FROM favorites WHERE id NOT IN (
+            SELECT MAX(id) FROM favorites GROUP BY user_id, stock_code
+        )
+        """
+    )
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS uq_fav_user_code ON favorites(user_id, stock_code)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_watchlist_code ON watchlist(stock_code)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_watchlist_category_time ON watchlist(category, added_time)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_watchlist_time ON watchlist(added_time)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_history_time ON search_history(search_time)')
+
+
+def _migration_unique_watchlist(cursor):
+    """v3：關注清單的股票代碼唯一，供 ON CONFLICT 使用"""
+    # 重複的代碼只保留最早加入的一筆
+    cursor.execute(
+        """
+        DELETE FROM watchlist WHERE id NOT IN (
+            SELECT MIN(id) FROM watchlist GROUP BY stock_code
+        )
+        """
+    )
+    cursor.execute('DROP INDEX IF EXISTS idx_watchlist_code')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS uq_watchlist_code ON watchlist(stock_code)')
+
+
+def _migration_keyset_indexes(cursor):
+    """v4：分頁依 (時間, id) 倒序，索引帶上 id 讓 keyset 條件可直接走索引"""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_fav_user_time_id ON favorites(user_id, liked_time, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_fav_time_id ON favorites(liked_time, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_watchlist_category_time_id ON watchlist(category, added_time, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_watchlist_time_id ON watchlist(added_time, id)')
+    cursor.execute('DROP INDEX IF EXISTS idx_fav_user_time')
+    cursor.execute('DROP INDEX IF EXISTS idx_watchlist_category_time')
+    cursor.execute('DROP INDEX IF EXISTS idx_watchlist_time')
+
+
+def _migration_llm_cache(cursor):
+    """v5：AI 回覆快取"""
+    real = 'DOUBLE PRECISION' if DB_IS_PG else 'REAL'
+    cursor.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            cache_key TEXT PRIMARY KEY,
+            provider TEXT NOT NULL,
+            model TEXT NOT NULL,
+            prompt_hash TEXT NOT NULL,
+            data_date TEXT NOT NULL,
+            response TEXT NOT NULL,
+            created_at {real} NOT NULL,
+            last_hit_at {real} NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_llm_cache_created ON llm_cache(created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_llm_cache_last_hit ON llm_cache(last_hit_at)')
+
+
+# (版本, 名稱, 遷移函式)；只能在尾端追加，已發布的版本不可修改
+MIGRATIONS = [
+    (1, 'base tables', _migration_base_tables),
+    (2, 'query indexes', _migration_query_indexes),
+    (3, 'unique watchlist code', _migration_unique_watchlist),
+    (4, 'keyset indexes', _migration_keyset_indexes),
+    (5, 'llm cache', _migration_llm_cache),
+]
+
+
+def _applied_migrations(cursor):
+    cursor.execute('SELECT version FROM schema_migrations')
+    return {row[0] for row in cursor.fetchall()}
+
+
 def init_db():
+    """依序套用尚未執行的遷移，每個版本一個交易"""
     with closing(get_conn()) as conn:
-        # row 工廠設定（SQLite 使用 conn 層級，PG 使用 cursor 參數）
-        if not DB_IS_PG:
-            conn.row_factory = sqlite3.Row
-        with closing(conn.cursor(row_factory=dict_row) if DB_IS_PG else conn.cursor()) as cursor:
-            if DB_IS_PG:
-                cursor.execute(
-                    """
-                    CREATE TABLE IF NOT EXISTS watchlist (
-                        id SERIAL PRIMARY KEY,
-                        stock_code TEXT NOT NULL,
-                        stock_name TEXT,
-                        category TEXT NOT NULL,
-                        added_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                    """
-                )
-                cursor.execute(
-                    """
-                    CREATE TABLE IF NOT EXISTS search_history (
-                        id SERIAL PRIMARY KEY,
-                        stock_code TEXT NOT NULL,
-                        stock_name TEXT,
-                        search_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                    """
-                )
-                cursor.execute(
-                    """
-                    CREATE TABLE IF NOT EXISTS favorites (
-                        id SERIAL PRIMARY KEY,
-                        user_id TEXT NOT NULL,
-                        stock_code TEXT NOT NULL,
-                        stock_name TEXT,
-                        liked_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                    """
-                )
-                cursor.execute(
-                    """
-                    CREATE INDEX IF NOT EXISTS idx_fav_user_time ON favorites(user_id, liked_time)
-                    """
-                )
-                cursor.execute(
-                    """
-                    CREATE TABLE IF NOT EXISTS users (
-                        id SERIAL PRIMARY KEY,
-                        user_id TEXT NOT NULL UNIQUE,
-                        password_hash TEXT NOT NULL,
-                        is_admin BOOLEAN DEFAULT FALSE,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                    """
-                )
-                cursor.execute(
-                    """
-                    CREATE TABLE IF NOT EXISTS app_config (
-                        config_key TEXT PRIMARY KEY,
-                        config_value TEXT NOT NULL,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                    """
-                )
-            else:
-                cursor.execute(
-                    """
-                    CREATE TABLE IF NOT EXISTS watchlist (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        stock_code TEXT NOT NULL,
-                        stock_name TEXT,
-                        category TEXT NOT NULL,
-                        added_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                    """
-                )
-                cursor.execute(
-                    """
-                    CREATE TABLE IF NOT EXISTS search_history (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        stock_code TEXT NOT NULL,
-                        stock_name TEXT,
-                        search_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                    """
-                )
-                cursor.execute(
-                    """
-                    CREATE TABLE IF NOT EXISTS favorites (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id TEXT NOT NULL,
-                        stock_code TEXT NOT NULL,
-                        stock_name TEXT,
-                        liked_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                    """
-                )
-                cursor.execute(
-                    """
-                    CREATE INDEX IF NOT EXISTS idx_fav_user_time ON favorites(user_id, liked_time)
-                    """
-                )
-                cursor.execute(
-                    """
-                    CREATE TABLE IF NOT EXISTS users (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id TEXT NOT NULL UNIQUE,
-                        password_hash TEXT NOT NULL,
-                        is_admin INTEGER DEFAULT 0,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                    """
-                )
-                cursor.execute(
-                    """
-                    CREATE TABLE IF NOT EXISTS app_config (
-                        config_key TEXT PRIMARY KEY,
-                        config_value TEXT NOT NULL,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                    """
+        with closing(conn.cursor()) as cursor:
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
+                """
+            )
             conn.commit()
 
+            for version, name, migrate in MIGRATIONS:
+                if DB_IS_PG:
+                    # 多個 worker 同時啟動時只讓一個執行遷移
+                    cursor.execute('LOCK TABLE schema_migrations IN EXCLUSIVE MODE')
+                else:
+                    cursor.execute('BEGIN IMMEDIATE')
+                if version in _applied_migrations(cursor):
+                    conn.rollback()
+                    continue
+                try:
+                    migrate(cursor)
+                    cursor.execute(q('INSERT INTO schema_migrations (version, name) VALUES (?, ?)'), (version, name))
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                print(f"✓ 資料庫遷移 v{version}: {name}")
+
 init_db()
 
-def get_twse_data(stock_code, years=5):
+# ========== 資料存取層 ==========
+class Statement:
+    """匯入時即依資料庫方言編譯好的 SQL；pg_sql 用於兩種方言語法不同的情況"""
+
+    __slots__ = ('sql',)
+
+    def __init__(self, sql, pg_sql=None):
+        if DB_IS_PG:
+            self.sql = pg_sql if pg_sql is not None else sql.replace('?', '%s')
+        else:
+            self.sql = sql
+
+
+class Repository:
     """
-    從台灣證券交易所獲取股票資料（多年份）
+    資料表存取基底類別：PostgreSQL 使用伺服器端預備語句（prepare=True），
+    查詢結果統一為 dict；conn 可傳入呼叫端已借出的連線
     """
-    try:
-        from dateutil.relativedelta import relativedelta
-        import time
-        
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        }
-        
-        all_data = []
-        current_date = datetime.now()
-        
-        # 計算起始日期（往前推 years 年）
-        start_date = current_date - relativedelta(years=years)
-        
-        # 遍歷每個月
-        temp_date = start_date
-        while temp_date <= current_date:
-            try:
-                date_str = temp_date.strftime('%Y%m%d')
-                url = f'https://www.twse.com.tw/exchangeReport/STOCK_DAY?response=json&date={date_str}&stockNo={stock_code}'
-                
-                response = requests.get(url, headers=headers, timeout=10)
-                data = response.json()
-                
-                if data.get('stat') == 'OK' and data.get('data'):
-                    all_data.extend(data['data'])
-                
-                # 避免請求過快，加入延遲
-                time.sleep(0.5)
-                
-            except Exception as e:
-                print(f"獲取 {date_str} 數據失敗: {e}")
-            
-            # 移到下個月
-            temp_date = temp_date + relativedelta(months=1)
-        
-        if all_data:
-            return {
-                'success': True,
-                'stock_code': stock_code,
-                'data': all_data,
-                'fields': ['日期', '成交股數', '成交金額', '開盤價', '最高價', '最低價', '收盤價', '漲跌價差', '成交筆數']
-            }
+
+    @staticmethod
+    def _execute(cursor, stmt, params):
+        if DB_IS_PG:
+            cursor.execute(stmt.sql, params, prepare=True)
         else:
-            return {
-                'success': False,
-                'message': '查無此股票代碼或資料尚未更新'
-            }
-    except Exception as e:
-        return {
-            'success': False,
-            'message': f'錯誤: {str(e)}'
-        }
+            cursor.execute(stmt.sql, params)
+
+    @classmethod
+    def _run(cls, handler, conn):
+        if conn is None:
+            with closing(get_conn()) as own_conn:
+                return cls._run(handler, own_conn)
+        with closing(conn.cursor(row_factory=dict_row) if DB_IS_PG else conn.cursor()) as cursor:
+            return handler(conn, cursor)
+
+    @staticmethod
+    def _dict_rows(cursor, rows):
+        if DB_IS_PG:
+            return rows
+        names = [column[0] for column in cursor.description]
+        return [dict(zip(names, row)) for row in rows]
+
+    @classmethod
+    def query(cls, stmt, params=(), conn=None):
+        def handler(_, cursor):
+            cls._execute(cursor, stmt, params)
+            return cls._dict_rows(cursor, cursor.fetchall())
+        return cls._run(handler, conn)
+
+    @classmethod
+    def query_one(cls, stmt, params=(), conn=None):
+        def handler(_, cursor):
+            cls._execute(cursor, stmt, params)
+            row = cursor.fetchone()
+            return cls._dict_rows(cursor, [row])[0] if row else None
+        return cls._run(handler, conn)
+
+    @classmethod
+    def execute(cls, stmt, params=(), conn=None):
+        """執行寫入並提交，返回影響筆數"""
+        def handler(active_conn, cursor):
+            cls._execute(cursor, stmt, params)
+            active_conn.commit()
+            return cursor.rowcount
+        return cls._run(handler, conn)
+
+    @classmethod
+    def execute_many(cls, stmt, params_seq, conn=None):
+        """同一語句批次寫入，整批一個交易"""
+        def handler(active_conn, cursor):
+            try:
+                cursor.executemany(stmt.sql, params_seq)
+                active_conn.commit()
+            except Exception:
+                active_conn.rollback()
+                raise
+        return cls._run(handler, conn)
+
+    @classmethod
+    def stream(cls, stmt, params=(), batch_size=500):
+        """
+        逐批產生查詢結果（每批為 dict 清單），不一次載入全部資料
+        PostgreSQL 使用伺服器端具名游標，SQLite 游標本身即逐步讀取
+        """
+        with closing(get_conn()) as conn:
+            if DB_IS_PG:
+                cursor = conn.cursor(name=f'stream_{next(_stream_cursor_ids)}', row_factory=dict_row)
+            else:
+                cursor = conn.cursor()
+            with closing(cursor):
+                cursor.execute(stmt.sql, params)
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield cls._dict_rows(cursor, rows)
+
 
-def get_stock_info(stock_code):
+_stream_cursor_ids = itertools.count(1)
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+
+class KeysetQuery:
     """
-    獲取即時股票資訊（使用 mis API）並包含歷史數據
+    依 (時間欄位, id) 倒序的 keyset 分頁查詢
+    (篩選, after, limit) 各種組合於匯入時預先編譯
     """
-    try:
-        url = f'https://mis.twse.com.tw/stock/api/getStockInfo.jsp?ex_ch=tse_{stock_code}.tw'
-        
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        }
-        
-        response = requests.get(url, headers=headers, timeout=10)
-        data = response.json()
-        
-        if data.get('msgArray') and len(data['msgArray']) > 0:
-            stock = data['msgArray'][0]
-            result = {
-                'success': True,
-                'stock_code': stock.get('c', ''),
-                'stock_name': stock.get('n', ''),
-                'current_price': stock.get('z', '-'),
-                'change': stock.get('y', '-'),
-                'open': stock.get('o', '-'),
-                'high': stock.get('h', '-'),
-                'low': stock.get('l', '-'),
-                'volume': stock.get('v', '-'),
-                'time': stock.get('t', '')
-            }
-            
-            # 獲取歷史數據用於 K 線圖
-            history_data = get_twse_data(stock_code)
-            if history_data.get('success') and history_data.get('data'):
-                kline_data = []
-                for row in history_data['data']:
-                    try:
-                        # TWSE 數據格式: [日期, 成交股數, 成交金額, 開盤價, 最高價, 最低價, 收盤價, 漲跌價差, 成交筆數]
-                        date = row[0].replace('/', '-')
-                        open_price = float(row[3].replace(',', ''))
-                        high_price = float(row[4].replace(',', ''))
-                        low_price = float(row[5].replace(',', ''))
-                        close_price = float(row[6].replace(',', ''))
-                        volume = float(row[1].replace(',', ''))
-                        
-                        kline_data.append([date, open_price, close_price, low_price, high_price, volume])
-                    except (ValueError, IndexError):
-                        continue
-                
-                result['kline_data'] = kline_data
-                
-                # 計算技術指標
-                if kline_data and len(kline_data) > 0:
-                    result['technical_indicators'] = calculate_technical_indicators(kline_data)
-            
-            return result
-        else:
-            return {
-                'success': False,
-                'message': '查無此股票代碼'
-            }
-    except Exception as e:
-        return {
-            'success': False,
-            'message': f'錯誤: {str(e)}'
-        }
 
+    def __init__(self, table, time_column, filter_column):
+        self.time_column = time_column
+        self._statements = {}
+        for filtered in (False, True):
+            for after in (False, True):
+                for limited in (False, True):
+                    where = []
+                    if filtered:
+                        where.append(f'{filter_column} = ?')
+                    if after:
+                        where.append(f'({time_column}, id) < (?, ?)')
+                    sql = f'SELECT * FROM {table}'
+                    if where:
+                        sql += ' WHERE ' + ' AND '.join(where)
+                    sql += f' ORDER BY {time_column} DESC, id DESC'
+                    if limited:
+                        sql += ' LIMIT ?'
+                    self._statements[(filtered, after, limited)] = Statement(sql)
+
+    def build(self, filter_value=None, after=None, limit=None):
+        """返回 (Statement, 參數)；after 為 (時間, id)"""
+        params = []
+        if filter_value is not None:
+            params.append(filter_value)
+        if after is not None:
+            params.extend(after)
+        if limit is not None:
+            params.append(limit)
+        key = (filter_value is not None, after is not None, limit is not None)
+        return self._statements[key], tuple(params)
 
-def calculate_technical_indicators(kline_data):
+    def cursor_of(self, row):
+        """某筆資料的分頁游標字串「時間,id」"""
+        return f'{row[self.time_column]},{row["id"]}'
+
+
+class WatchlistRepo(Repository):
+    LIST_ALL = Statement('SELECT * FROM watchlist ORDER BY added_time DESC')
+    LIST_BY_CATEGORY = Statement('SELECT * FROM watchlist WHERE category = ? ORDER BY added_time DESC')
+    CODES = Statement('SELECT stock_code FROM watchlist')
+    INSERT = Statement(
+        'INSERT INTO watchlist (stock_code, stock_name, category) VALUES (?, ?, ?) '
+        'ON CONFLICT (stock_code) DO NOTHING'
+    )
+    DELETE = Statement('DELETE FROM watchlist WHERE id = ?')
+
+    @classmethod
+    def list(cls, category=None, conn=None):
+        if category:
+            return cls.query(cls.LIST_BY_CATEGORY, (category,), conn)
+        return cls.query(cls.LIST_ALL, (), conn)
+
+    PAGES = KeysetQuery('watchlist', 'added_time', 'category')
+
+    @classmethod
+    def page(cls, category=None, after=None, limit=None, conn=None):
+        return cls.query(*cls.PAGES.build(category, after, limit), conn=conn)
+
+    @classmethod
+    def stream(cls, category=None, after=None, limit=None):
+        return Repository.stream(*cls.PAGES.build(category, after, limit))
+
+    @classmethod
+    def codes(cls, conn=None):
+        return [row['stock_code'] for row in cls.query(cls.CODES, (), conn)]
+
+    @classmethod
+    def add(cls, stock_code, stock_name, category, conn=None):
+        """新增一筆；代碼已在清單中時返回 False"""
+        return cls.execute(cls.INSERT, (stock_code, stock_name, category), conn) > 0
+
+    @classmethod
+    def delete(cls, watch_id, conn=None):
+        return cls.execute(cls.DELETE, (watch_id,), conn)
+
+
+class FavoritesRepo(Repository):
+    LIST_ALL = Statement('SELECT * FROM favorites ORDER BY user_id, liked_time DESC')
+    LIST_FOR_USER = Statement('SELECT * FROM favorites WHERE user_id = ? ORDER BY liked_time DESC')
+    LAST_FOR_USER = Statement('SELECT * FROM favorites WHERE user_id = ? ORDER BY liked_time DESC LIMIT 1')
+    # 已存在則更新時間為最新
+    UPSERT = Statement(
+        'INSERT INTO favorites (user_id, stock_code, stock_name) VALUES (?, ?, ?) '
+        'ON CONFLICT (user_id, stock_code) DO UPDATE '
+        'SET liked_time = CURRENT_TIMESTAMP, stock_name = excluded.stock_name'
+    )
+    DELETE_BY_ID = Statement('DELETE FROM favorites WHERE id = ?')
+    DELETE_BY_ID_FOR_USER = Statement('DELETE FROM favorites WHERE id = ? AND user_id = ?')
+    DELETE_BY_CODE = Statement('DELETE FROM favorites WHERE user_id = ? AND stock_code = ?')
+
+    @classmethod
+    def list(cls, user_id=None, conn=None):
+        """user_id 為 None 時返回所有使用者的最愛（管理員用）"""
+        if user_id is None:
+            return cls.query(cls.LIST_ALL, (), conn)
+        return cls.query(cls.LIST_FOR_USER, (user_id,), conn)
+
+    # 分頁時不分使用者，一律依加入時間倒序
+    PAGES = KeysetQuery('favorites', 'liked_time', 'user_id')
+
+    @classmethod
+    def page(cls, user_id=None, after=None, limit=None, conn=None):
+        return cls.query(*cls.PAGES.build(user_id, after, limit), conn=conn)
+
+    @classmethod
+    def stream(cls, user_id=None, after=None, limit=None):
+        return Repository.stream(*cls.PAGES.build(user_id, after, limit))
+
+    @classmethod
+    def last(cls, user_id, conn=None):
+        return cls.query_one(cls.LAST_FOR_USER, (user_id,), conn)
+
+    @classmethod
+    def add(cls, user_id, stock_code, stock_name, conn=None):
+        return cls.execute(cls.UPSERT, (user_id, stock_code, stock_name), conn)
+
+    @classmethod
+    def add_many(cls, user_id, names, conn=None):
+        """names: {代碼: 名稱}，一個交易內全部寫入"""
+        return cls.execute_many(cls.UPSERT, [(user_id, code, name) for code, name in names.items()], conn)
+
+    @classmethod
+    def delete(cls, fav_id, user_id=None, conn=None):
+        if user_id:
+            return cls.execute(cls.DELETE_BY_ID_FOR_USER, (fav_id, user_id), conn)
+        return cls.execute(cls.DELETE_BY_ID, (fav_id,), conn)
+
+    @classmethod
+    def delete_code(cls, user_id, stock_code, conn=None):
+        return cls.execute(cls.DELETE_BY_CODE, (user_id, stock_code), conn)
+
+
+class ReadThroughCache:
     """
-    計算技術指標
+    讀穿快取：未命中時呼叫 loader 並記住結果，寫入端明確 invalidate
+    TTL 只是多程序部署時其他 worker 修改資料後的更新上限
+    每個鍵有世代計數，載入期間被 invalidate 的結果不寫入快取，避免舊值存活到 TTL 結束
     """
-    try:
-        if not TALIB_AVAILABLE or len(kline_data) < 20:
-            return {}
-        
-        # 提取收盤價
-        closes = [item[2] for item in kline_data]
-        highs = [item[4] for item in kline_data]
-        lows = [item[3] for item in kline_data]
-        
-        df = pd.DataFrame({
-            'close': closes,
-            'high': highs,
-            'low': lows
-        })
-        
-        indicators = {}
-        
-        # RSI
-        try:
-            rsi = ta.momentum.RSIIndicator(df['close'], window=14)
-            indicators['RSI'] = float(rsi.rsi().iloc[-1])
-        except:
-            pass
-        
-        # MACD
+
+    _MISSING = object()
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, loader):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key, self._MISSING)
+            if entry is not self._MISSING and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self._generations.get(key, 0)
+        value = loader()
+        with self._lock:
+            if self._generations.get(key, 0) != generation:
+                return value
+            self._entries[key] = (now + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generations[key] = self._generations.get(key, 0) + 1
+            self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+LOOKUP_CACHE_TTL = float(os.environ.get('LOOKUP_CACHE_TTL', '60'))
+config_cache = ReadThroughCache(LOOKUP_CACHE_TTL, 256)
+admin_flag_cache = ReadThroughCache(LOOKUP_CACHE_TTL, 10000)
+
+
+class UsersRepo(Repository):
+    GET = Statement('SELECT * FROM users WHERE user_id = ?')
+    IS_ADMIN = Statement('SELECT is_admin FROM users WHERE user_id = ?')
+    COUNT = Statement('SELECT COUNT(*) AS cnt FROM users')
+    INSERT = Statement('INSERT INTO users (user_id, password_hash, is_admin) VALUES (?, ?, ?)')
+
+    @staticmethod
+    def _normalize(row):
+        # SQLite 以 0/1 儲存布林值
+        if row is not None:
+            row['is_admin'] = bool(row.get('is_admin'))
+        return row
+
+    @classmethod
+    def get(cls, user_id, conn=None):
+        return cls._normalize(cls.query_one(cls.GET, (user_id,), conn))
+
+    @classmethod
+    def is_admin(cls, user_id, conn=None):
+        """經 admin_flag_cache；不存在的使用者為 False"""
+        def load():
+            row = cls.query_one(cls.IS_ADMIN, (user_id,), conn)
+            return bool(row['is_admin']) if row else False
+        return admin_flag_cache.get(user_id, load)
+
+    @classmethod
+    def count(cls, conn=None):
+        return cls.query_one(cls.COUNT, (), conn)['cnt']
+
+    @classmethod
+    def create(cls, user_id, password_hash, is_admin, conn=None):
         try:
-            macd = ta.trend.MACD(df['close'])
-            indicators['MACD'] = float(macd.macd().iloc[-1])
-            indicators['MACD_SIGNAL'] = float(macd.macd_signal().iloc[-1])
-        except:
-            pass
-        
-        # 布林通道
+            return cls.execute(cls.INSERT, (user_id, password_hash, is_admin if DB_IS_PG else int(is_admin)), conn)
+        finally:
+            admin_flag_cache.invalidate(user_id)
+
+
+class ConfigRepo(Repository):
+    GET = Statement('SELECT config_value FROM app_config WHERE config_key = ?')
+    SET = Statement(
+        'INSERT OR REPLACE INTO app_config (config_key, config_value) VALUES (?, ?)',
+        pg_sql='INSERT INTO app_config (config_key, config_value) VALUES (%s, %s) '
+               'ON CONFLICT (config_key) DO UPDATE SET config_value = EXCLUDED.config_value'
+    )
+
+    @classmethod
+    def get(cls, key, default=None, conn=None):
+        """經 config_cache；未設定時返回 default"""
+        def load():
+            row = cls.query_one(cls.GET, (key,), conn)
+            return row['config_value'] if row else None
+        value = config_cache.get(key, load)
+        return default if value is None else value
+
+    @classmethod
+    def set(cls, key, value, conn=None):
         try:
-            bollinger = ta.volatility.BollingerBands(df['close'])
-            indicators['BB_UPPER'] = float(bollinger.bollinger_hband().iloc[-1])
-            indicators['BB_MIDDLE'] = float(bollinger.bollinger_mavg().iloc[-1])
-            indicators['BB_LOWER'] = float(bollinger.bollinger_lband().iloc[-1])
-        except:
-            pass
-        
-        # KD
+            return cls.execute(cls.SET, (key, value), conn)
+        finally:
+            config_cache.invalidate(key)
+
+
+class SearchHistoryRepo(Repository):
+    RECENT = Statement('SELECT * FROM search_history ORDER BY search_time DESC LIMIT ?')
+    INSERT = Statement('INSERT INTO search_history (stock_code, stock_name, search_time) VALUES (?, ?, ?)')
+    # 只保留最新 n 筆
+    PRUNE = Statement(
+        'DELETE FROM search_history WHERE id <= '
+        '(SELECT id FROM search_history ORDER BY id DESC LIMIT 1 OFFSET ?)'
+    )
+
+    @classmethod
+    def recent(cls, limit, conn=None):
+        return cls.query(cls.RECENT, (limit,), conn)
+
+    @classmethod
+    def add_many(cls, rows, conn=None):
+        """rows: [(stock_code, stock_name, search_time)]"""
+        return cls.execute_many(cls.INSERT, rows, conn)
+
+    @classmethod
+    def prune(cls, keep, conn=None):
+        return cls.execute(cls.PRUNE, (keep,), conn)
+
+
+class LlmCacheRepo(Repository):
+    GET = Statement('SELECT response FROM llm_cache WHERE cache_key = ? AND created_at >= ?')
+    TOUCH = Statement('UPDATE llm_cache SET hits = hits + 1, last_hit_at = ? WHERE cache_key = ?')
+    PUT = Statement(
+        'INSERT INTO llm_cache (cache_key, provider, model, prompt_hash, data_date, response, created_at, last_hit_at) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+        'ON CONFLICT (cache_key) DO UPDATE SET response = excluded.response, '
+        'created_at = excluded.created_at, last_hit_at = excluded.last_hit_at, hits = 0'
+    )
+    EXPIRE = Statement('DELETE FROM llm_cache WHERE created_at < ?')
+    # 超過筆數上限時刪除最久未命中的資料
+    EVICT = Statement(
+        'DELETE FROM llm_cache WHERE last_hit_at <= '
+        '(SELECT last_hit_at FROM llm_cache ORDER BY last_hit_at DESC LIMIT 1 OFFSET ?)'
+    )
+
+    @classmethod
+    def lookup(cls, cache_key, ttl):
+        """未過期的快取回覆，並更新命中次數；沒有時返回 None"""
+        now = time.time()
+        with closing(get_conn()) as conn:
+            row = cls.query_one(cls.GET, (cache_key, now - ttl), conn)
+            if row:
+                cls.execute(cls.TOUCH, (now, cache_key), conn)
+        return row['response'] if row else None
+
+    @classmethod
+    def store(cls, cache_key, provider, model, prompt_hash, data_date, response):
+        now = time.time()
+        return cls.execute(cls.PUT, (cache_key, provider, model, prompt_hash, data_date, response, now, now))
+
+    @classmethod
+    def prune(cls, ttl, max_entries):
+        with closing(get_conn()) as conn:
+            cls.execute(cls.EXPIRE, (time.time() - ttl,), conn)
+            cls.execute(cls.EVICT, (max_entries,), conn)
+
+
+# 熱門查詢與範例參數，用於檢查查詢計畫是否走索引
+PLAN_CHECKS = [
+    ('watchlist by category', WatchlistRepo.LIST_BY_CATEGORY, ('半導體',)),
+    ('watchlist all', WatchlistRepo.LIST_ALL, ()),
+    ('favorites by user', FavoritesRepo.LIST_FOR_USER, ('user',)),
+    ('last favorite', FavoritesRepo.LAST_FOR_USER, ('user',)),
+    ('user by id', UsersRepo.GET, ('user',)),
+    ('config by key', ConfigRepo.GET, ('default_ollama_model',)),
+    ('recent searches', SearchHistoryRepo.RECENT, (50,)),
+    ('llm cache lookup', LlmCacheRepo.GET, ('key', 0)),
+    ('favorites page', *FavoritesRepo.PAGES.build('user', ('2024-01-01 00:00:00', 1), DEFAULT_PAGE_SIZE)),
+    ('favorites page (all users)', *FavoritesRepo.PAGES.build(None, ('2024-01-01 00:00:00', 1), DEFAULT_PAGE_SIZE)),
+    ('watchlist page', *WatchlistRepo.PAGES.build('半導體', ('2024-01-01 00:00:00', 1), DEFAULT_PAGE_SIZE)),
+    ('watchlist page (all)', *WatchlistRepo.PAGES.build(None, ('2024-01-01 00:00:00', 1), DEFAULT_PAGE_SIZE)),
+]
+
+
+def check_query_plans():
+    """
+    對 PLAN_CHECKS 執行 EXPLAIN，返回 [{name, plan, table_scan}]
+    PostgreSQL 會關閉 seqscan，小資料表也能看出是否有可用的索引
+    """
+    results = []
+    with closing(get_conn()) as conn:
+        with closing(conn.cursor()) as cursor:
+            if DB_IS_PG:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+            for name, stmt, params in PLAN_CHECKS:
+                if DB_IS_PG:
+                    cursor.execute('EXPLAIN ' + stmt.sql, params)
+                    plan = [row[0] for row in cursor.fetchall()]
+                    table_scan = any('Seq Scan' in line for line in plan)
+                else:
+                    cursor.execute('EXPLAIN QUERY PLAN ' + stmt.sql, params)
+                    plan = [row[-1] for row in cursor.fetchall()]
+                    table_scan = any(
+                        line.startswith('SCAN') and 'USING' not in line or 'TEMP B-TREE' in line
+                        for line in plan
+                    )
+                results.append({'name': name, 'plan': plan, 'table_scan': table_scan})
+        conn.rollback()
+    return results
+
+
+@app.cli.command('check-plans')
+def check_plans_command():
+    """flask --app app check-plans：熱門查詢出現全表掃描時以非 0 結束"""
+    results = check_query_plans()
+    for result in results:
+        mark = '✗' if result['table_scan'] else '✓'
+        print(f"{mark} {result['name']}: {' | '.join(result['plan'])}")
+    if any(result['table_scan'] for result in results):
+        raise SystemExit(1)
+
+# ========== 日線資料本地儲存 ==========
+TWSE_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+}
+TWSE_FIELDS = ['日期', '成交股數', '成交金額', '開盤價', '最高價', '最低價', '收盤價', '漲跌價差', '成交筆數']
+TWSE_COLUMNS = ['date', 'volume', 'amount', 'open', 'high', 'low', 'close', 'change', 'transactions']
+BAR_VALUE_COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+
+# 當月資料仍會變動，距上次抓取超過此秒數才重新向證交所請求
+BAR_CURRENT_MONTH_TTL = int(os.environ.get('BAR_CURRENT_MONTH_TTL', '300'))
+
+# 證交所請求排程：全域限流（所有請求共用）、連線池、暫時性錯誤重試
+TWSE_RATE_LIMIT = float(os.environ.get('TWSE_RATE_LIMIT', '2'))
+TWSE_RATE_BURST = int(os.environ.get('TWSE_RATE_BURST', '4'))
+TWSE_FETCH_WORKERS = int(os.environ.get('TWSE_FETCH_WORKERS', '4'))
+TWSE_MAX_RETRIES = int(os.environ.get('TWSE_MAX_RETRIES', '3'))
+TWSE_RETRY_BACKOFF = float(os.environ.get('TWSE_RETRY_BACKOFF', '1.0'))
+TWSE_TRANSIENT_STATUS = {429, 500, 502, 503, 504}
+# 查無資料時的 stat 訊息（結尾驚嘆號有全形與半形兩種）
+TWSE_NO_DATA_MESSAGE = '沒有符合條件的資料'
+
+_bar_fill_locks = {}
+_bar_fill_locks_guard = threading.Lock()
+
+
+class TokenBucket:
+    """執行緒安全的 token bucket 限流器"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """取得一個 token，不足時阻塞等待"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def _make_session(pool_size: int) -> requests.Session:
+    """建立帶 keep-alive 連線池的 Session"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update(TWSE_HEADERS)
+    return session
+
+
+twse_session = _make_session(TWSE_FETCH_WORKERS)
+twse_rate_limiter = TokenBucket(TWSE_RATE_LIMIT, TWSE_RATE_BURST)
+_twse_executor = ThreadPoolExecutor(max_workers=TWSE_FETCH_WORKERS, thread_name_prefix='twse-fetch')
+
+
+def twse_get_json(url):
+    """經由全域限流器與共用連線池請求證交所 JSON，暫時性錯誤以指數退避重試"""
+    for attempt in range(TWSE_MAX_RETRIES + 1):
+        twse_rate_limiter.acquire()
         try:
-            stoch = ta.momentum.StochasticOscillator(df['high'], df['low'], df['close'])
-            indicators['KD_K'] = float(stoch.stoch().iloc[-1])
-            indicators['KD_D'] = float(stoch.stoch_signal().iloc[-1])
-        except:
-            pass
-        
-        return indicators
+            response = twse_session.get(url, timeout=10)
+            if response.status_code in TWSE_TRANSIENT_STATUS:
+                raise requests.HTTPError(f'HTTP {response.status_code}', response=response)
+            return response.json()
+        except (requests.RequestException, ValueError):
+            if attempt >= TWSE_MAX_RETRIES:
+                raise
+            time.sleep(TWSE_RETRY_BACKOFF * (2 ** attempt) + random.uniform(0, 0.25))
+
+
+def _bar_fill_lock(stock_code):
+    """同一檔股票同時只允許一個請求補抓資料"""
+    with _bar_fill_locks_guard:
+        return _bar_fill_locks.setdefault(stock_code, threading.Lock())
+
+
+def _parse_twse_number(value):
+    """證交所數字字串（含千分位逗號）轉 float，無法解析時返回 None"""
+    try:
+        return float(str(value).replace(',', ''))
+    except (TypeError, ValueError):
+        return None
+
+
+def _roc_to_iso(roc_date: str) -> str:
+    """民國日期 113/01/02 轉為 2024-01-02"""
+    year, month, day = roc_date.strip().split('/')
+    return f'{int(year) + 1911:04d}-{int(month):02d}-{int(day):02d}'
+
+
+def _month_keys(years):
+    """往前推 years 年起至本月的月份清單（YYYYMM）"""
+    from dateutil.relativedelta import relativedelta
+
+    current = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    temp = current - relativedelta(years=years)
+    months = []
+    while temp <= current:
+        months.append(temp.strftime('%Y%m'))
+        temp = temp + relativedelta(months=1)
+    return months
+
+
+def _month_end_ts(month: str) -> float:
+    """月份結束時間（下個月 1 日 00:00）的 epoch 秒數"""
+    from dateutil.relativedelta import relativedelta
+
+    return (datetime.strptime(month, '%Y%m') + relativedelta(months=1)).timestamp()
+
+
+def _month_needs_fetch(month, fetched_at, now_ts):
+    """判斷月份是否需要向證交所抓取：已收盤月份視為不可變，只有當月會過期"""
+    if fetched_at is None:
+        return True
+    month_end = _month_end_ts(month)
+    if fetched_at >= month_end:
+        return False
+    if now_ts < month_end:
+        return now_ts - fetched_at > BAR_CURRENT_MONTH_TTL
+    # 月中抓過但該月已結束，補抓一次完整資料
+    return True
+
+
+def _fetch_twse_month(stock_code, month):
+    """
+    向證交所抓取單月日線，返回原始資料列
+    請求失敗或證交所回覆錯誤（例如限流）時拋出例外，該月份不記錄，下次會重抓
+    """
+    url = f'https://www.twse.com.tw/exchangeReport/STOCK_DAY?response=json&date={month}01&stockNo={stock_code}'
+    data = twse_get_json(url)
+    stat = str(data.get('stat') or '')
+    if stat == 'OK':
+        return data.get('data') or []
+    # 查無資料（例如尚未上市）同樣視為抓取成功
+    if TWSE_NO_DATA_MESSAGE in stat:
+        return []
+    raise RuntimeError(f'證交所回應異常: {stat or "無 stat 欄位"}')
+
+
+def _load_month_status(stock_code, first_month):
+    """讀取已抓取月份與抓取時間"""
+    with closing(get_conn()) as conn:
+        with closing(conn.cursor()) as cursor:
+            cursor.execute(
+                q('SELECT month, fetched_at FROM bar_months WHERE stock_code = ? AND month >= ?'),
+                (stock_code, first_month)
+            )
+            return {row[0]: row[1] for row in cursor.fetchall()}
+
+
+def _store_bars(stock_code, fetched, fetched_at):
+    """將抓取結果寫入 daily_bars，並記錄月份抓取時間（同一交易內完成）"""
+    records = []
+    for rows in fetched.values():
+        for row in rows:
+            try:
+                trade_date = _roc_to_iso(row[0])
+            except (ValueError, IndexError, AttributeError):
+                continue
+            records.append((
+                stock_code,
+                trade_date,
+                _parse_twse_number(row[3]),
+                _parse_twse_number(row[4]),
+                _parse_twse_number(row[5]),
+                _parse_twse_number(row[6]),
+                _parse_twse_number(row[1]),
+                json.dumps(row, ensure_ascii=False)
+            ))
+    months = [(stock_code, month, fetched_at) for month in fetched]
+
+    with closing(get_conn()) as conn:
+        with closing(conn.cursor()) as cursor:
+            if DB_IS_PG:
+                if records:
+                    cursor.executemany(
+                        """
+                        INSERT INTO daily_bars (stock_code, trade_date, open, high, low, close, volume, raw_row)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                        ON CONFLICT (stock_code, trade_date) DO UPDATE SET
+                            open = EXCLUDED.open, high = EXCLUDED.high, low = EXCLUDED.low,
+                            close = EXCLUDED.close, volume = EXCLUDED.volume, raw_row = EXCLUDED.raw_row
+                        """,
+                        records
+                    )
+                cursor.executemany(
+                    """
+                    INSERT INTO bar_months (stock_code, month, fetched_at)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (stock_code, month) DO UPDATE SET fetched_at = EXCLUDED.fetched_at
+                    """,
+                    months
+                )
+            else:
+                if records:
+                    cursor.executemany(
+                        'INSERT OR REPLACE INTO daily_bars (stock_code, trade_date, open, high, low, close, volume, raw_row) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        records
+                    )
+                cursor.executemany(
+                    'INSERT OR REPLACE INTO bar_months (stock_code, month, fetched_at) VALUES (?, ?, ?)',
+                    months
+                )
+            conn.commit()
+
+
+def _load_raw_bars(stock_code, since_date):
+    """依日期排序讀取原始 TWSE 資料列"""
+    with closing(get_conn()) as conn:
+        with closing(conn.cursor()) as cursor:
+            cursor.execute(
+                q('SELECT raw_row FROM daily_bars WHERE stock_code = ? AND trade_date >= ? ORDER BY trade_date'),
+                (stock_code, since_date)
+            )
+            return [json.loads(row[0]) for row in cursor.fetchall()]
+
+
+def ensure_daily_bars(stock_code, years=5):
+    """
+    確保 daily_bars 已涵蓋往前 years 年的資料：只補抓缺漏月份與過期的當月資料
+    返回涵蓋範圍的起始日期（YYYY-MM-DD）
+    """
+    months = _month_keys(years)
+
+    with _bar_fill_lock(stock_code):
+        status = _load_month_status(stock_code, months[0])
+        now_ts = time.time()
+        missing = [m for m in months if _month_needs_fetch(m, status.get(m), now_ts)]
+
+        # 各月份並行抓取，實際請求速率由 twse_rate_limiter 控制
+        futures = {month: _twse_executor.submit(_fetch_twse_month, stock_code, month) for month in missing}
+        fetched = {}
+        for month, future in futures.items():
+            try:
+                fetched[month] = future.result()
+            except Exception as e:
+                print(f"獲取 {month} 數據失敗: {e}")
+
+        # 完全查無資料的代碼不寫入月份紀錄，避免無效代碼佔用儲存空間
+        if fetched and (status or any(fetched.values())):
+            _store_bars(stock_code, fetched, now_ts)
+
+    return f'{months[0][:4]}-{months[0][4:]}-01'
+
+
+def get_bar_frame(stock_code, years=5):
+    """讀取數值化日線 DataFrame（date 為 YYYY-MM-DD），必要時先補抓資料"""
+    since_date = ensure_daily_bars(stock_code, years)
+    with closing(get_conn()) as conn:
+        with closing(conn.cursor()) as cursor:
+            cursor.execute(
+                q('SELECT trade_date, open, high, low, close, volume FROM daily_bars '
+                  'WHERE stock_code = ? AND trade_date >= ? ORDER BY trade_date'),
+                (stock_code, since_date)
+            )
+            rows = cursor.fetchall()
+    bars = pd.DataFrame(rows, columns=['date', 'open', 'high', 'low', 'close', 'volume'])
+    bars[BAR_VALUE_COLUMNS] = bars[BAR_VALUE_COLUMNS].astype('float64')
+    return bars
+
+
+def get_twse_data(stock_code, years=5):
+    """
+    從台灣證券交易所獲取股票資料（多年份）
+    已收盤月份直接讀取本地 daily_bars，只補抓缺漏月份與過期的當月資料
+    """
+    try:
+        since_date = ensure_daily_bars(stock_code, years)
+        all_data = _load_raw_bars(stock_code, since_date)
+
+        if all_data:
+            return {
+                'success': True,
+                'stock_code': stock_code,
+                'data': all_data,
+                'fields': TWSE_FIELDS
+            }
+        else:
+            return {
+                'success': False,
+                'message': '查無此股票代碼或資料尚未更新'
+            }
+    except Exception as e:
+        return {
+            'success': False,
+            'message': f'錯誤: {str(e)}'
+        }
+
+# 股票代碼→名稱對照表（證交所 OpenAPI 全市場日成交資訊），每日更新一次
+STOCK_DIRECTORY_URL = 'https://openapi.twse.com.tw/v1/exchangeReport/STOCK_DAY_ALL'
+STOCK_DIRECTORY_TTL = int(os.environ.get('STOCK_DIRECTORY_TTL', '86400'))
+# 對照表載入失敗時，隔多久再重試
+STOCK_DIRECTORY_RETRY = 300
+
+_stock_directory = {}
+_stock_directory_expires = 0.0
+_stock_directory_lock = threading.Lock()
+
+
+def _load_stock_directory():
+    data = twse_session.get(STOCK_DIRECTORY_URL, timeout=10).json()
+    return {item['Code']: item['Name'] for item in data if item.get('Code') and item.get('Name')}
+
+
+def get_stock_names(stock_codes):
+    """
+    批次查詢股票名稱，返回 {代碼: 名稱}（查無為空字串）
+    優先使用快取的代碼對照表，查無的代碼整批請求即時報價
+    """
+    global _stock_directory_expires
+    with _stock_directory_lock:
+        if time.time() >= _stock_directory_expires:
+            try:
+                _stock_directory.update(_load_stock_directory())
+                _stock_directory_expires = time.time() + STOCK_DIRECTORY_TTL
+            except Exception as e:
+                print(f"載入股票代碼表失敗: {e}")
+                _stock_directory_expires = time.time() + STOCK_DIRECTORY_RETRY
+        names = {code: _stock_directory.get(code, '') for code in stock_codes}
+
+    missing = [code for code, name in names.items() if not name]
+    if missing:
+        quotes = get_stock_quotes(missing)
+        with _stock_directory_lock:
+            for code, quote in quotes.items():
+                if quote.get('stock_name'):
+                    names[code] = _stock_directory[code] = quote['stock_name']
+    return names
+
+
+def get_stock_name(stock_code):
+    """
+    查詢股票名稱：優先使用快取的代碼對照表，查無時才請求即時報價
+    """
+    return get_stock_names([stock_code])[stock_code]
+
+
+# MIS 即時報價：一次請求可帶多個 ex_ch（以 | 分隔）
+MIS_QUOTE_URL = 'https://mis.twse.com.tw/stock/api/getStockInfo.jsp'
+MIS_BATCH_SIZE = int(os.environ.get('MIS_BATCH_SIZE', '50'))
+MIS_FETCH_WORKERS = int(os.environ.get('MIS_FETCH_WORKERS', '4'))
+MAX_BATCH_QUOTE_CODES = 500
+
+_mis_executor = ThreadPoolExecutor(max_workers=MIS_FETCH_WORKERS, thread_name_prefix='mis-quote')
+
+
+def _parse_mis_quote(stock):
+    """MIS msgArray 單筆資料轉為報價格式"""
+    return {
+        'success': True,
+        'stock_code': stock.get('c', ''),
+        'stock_name': stock.get('n', ''),
+        'current_price': stock.get('z', '-'),
+        'change': stock.get('y', '-'),
+        'open': stock.get('o', '-'),
+        'high': stock.get('h', '-'),
+        'low': stock.get('l', '-'),
+        'volume': stock.get('v', '-'),
+        'time': stock.get('t', '')
+    }
+
+
+def _fetch_mis_quotes(stock_codes):
+    """單次 MIS 請求取得多檔報價，返回 {代碼: 報價}"""
+    ex_ch = '|'.join(f'tse_{code}.tw' for code in stock_codes)
+    data = twse_session.get(f'{MIS_QUOTE_URL}?ex_ch={ex_ch}', timeout=10).json()
+    quotes = {}
+    for stock in data.get('msgArray') or []:
+        quote = _parse_mis_quote(stock)
+        quotes[quote['stock_code']] = quote
+    return quotes
+
+
+# 報價快取：盤中短 TTL，盤後快取至下一個開盤時間
+QUOTE_CACHE_TTL = float(os.environ.get('QUOTE_CACHE_TTL', '5'))
+QUOTE_CACHE_MAX_ENTRIES = int(os.environ.get('QUOTE_CACHE_MAX_ENTRIES', '5000'))
+# 合併請求等待上游回應的最長秒數
+QUOTE_COALESCE_TIMEOUT = 15
+TAIPEI_TZ = timezone(timedelta(hours=8))
+# 盤中（含收盤後零股交易）時段，MIS 報價仍會變動
+MARKET_OPEN = (9, 0)
+MARKET_CLOSE = (14, 30)
+
+
+def _next_market_open(now: datetime) -> datetime:
+    """下一個交易日開盤時間（僅排除週末，不含國定假日）"""
+    candidate = now.replace(hour=MARKET_OPEN[0], minute=MARKET_OPEN[1], second=0, microsecond=0)
+    if candidate <= now:
+        candidate += timedelta(days=1)
+    while candidate.weekday() >= 5:
+        candidate += timedelta(days=1)
+    return candidate
+
+
+def quote_ttl(now_ts=None):
+    """依台北時間判斷報價可快取的秒數"""
+    now = datetime.fromtimestamp(now_ts if now_ts is not None else time.time(), TAIPEI_TZ)
+    open_at = now.replace(hour=MARKET_OPEN[0], minute=MARKET_OPEN[1], second=0, microsecond=0)
+    close_at = now.replace(hour=MARKET_CLOSE[0], minute=MARKET_CLOSE[1], second=0, microsecond=0)
+    if now.weekday() < 5 and open_at <= now < close_at:
+        return QUOTE_CACHE_TTL
+    return max((_next_market_open(now) - now).total_seconds(), QUOTE_CACHE_TTL)
+
+
+class _Flight:
+    """單一進行中的上游請求，讓同代碼的並行請求共用結果"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+
+    def resolve(self, value):
+        self.value = value
+        self.event.set()
+
+    def wait(self, timeout):
+        self.event.wait(timeout)
+        return self.value
+
+
+class QuoteCache:
+    """
+    行程內報價快取 + single-flight：
+    快取命中直接返回；同代碼已有請求進行中則等待共用結果；其餘代碼合併成一次 loader 呼叫
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get_many(self, stock_codes, loader):
+        results = {}
+        waiting = {}
+        flights = {}
+        now = time.time()
+        with self._lock:
+            for code in stock_codes:
+                entry = self._entries.get(code)
+                if entry and entry[0] > now:
+                    results[code] = entry[1]
+                    self.hits += 1
+                elif code in self._inflight:
+                    waiting[code] = self._inflight[code]
+                    self.coalesced += 1
+                elif code not in flights:
+                    flights[code] = self._inflight[code] = _Flight()
+                    self.misses += 1
+
+        if flights:
+            loaded = {}
+            try:
+                loaded = loader(list(flights))
+            finally:
+                expires_at = time.time() + quote_ttl()
+                with self._lock:
+                    for code in flights:
+                        if loaded.get(code) is not None:
+                            self._entries[code] = (expires_at, loaded[code])
+                        self._inflight.pop(code, None)
+                    if len(self._entries) > self.max_entries:
+                        self._evict()
+                for code, flight in flights.items():
+                    flight.resolve(loaded.get(code))
+            results.update({code: loaded[code] for code in flights if loaded.get(code) is not None})
+
+        for code, flight in waiting.items():
+            quote = flight.wait(QUOTE_COALESCE_TIMEOUT)
+            if quote is not None:
+                results[code] = quote
+
+        # 返回副本，避免呼叫端（例如附加 kline_data）修改到快取內容
+        return {code: dict(quote) for code, quote in results.items()}
+
+    def _evict(self):
+        """移除過期項目，仍超量時淘汰最早到期者"""
+        now = time.time()
+        for code in [c for c, (expires_at, _) in self._entries.items() if expires_at <= now]:
+            del self._entries[code]
+        overflow = len(self._entries) - self.max_entries
+        if overflow > 0:
+            for code, _ in sorted(self._entries.items(), key=lambda item: item[1][0])[:overflow]:
+                del self._entries[code]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'inflight': len(self._inflight),
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'ttl_seconds': round(quote_ttl(), 1)
+            }
+
+
+quote_cache = QuoteCache(QUOTE_CACHE_MAX_ENTRIES)
+
+
+def get_stock_quote(stock_code):
+    """
+    獲取即時股票報價（使用 mis API，經報價快取），不含歷史數據
+    """
+    try:
+        quote = quote_cache.get_many([stock_code], _fetch_mis_quotes).get(stock_code)
+        if quote:
+            return quote
+        else:
+            return {
+                'success': False,
+                'message': '查無此股票代碼'
+            }
     except Exception as e:
-        print(f"計算技術指標失敗: {e}")
+        return {
+            'success': False,
+            'message': f'錯誤: {str(e)}'
+        }
+
+
+def _load_quotes(stock_codes):
+    """依 MIS_BATCH_SIZE 分組後並行請求 MIS"""
+    chunks = [stock_codes[i:i + MIS_BATCH_SIZE] for i in range(0, len(stock_codes), MIS_BATCH_SIZE)]
+    futures = [_mis_executor.submit(_fetch_mis_quotes, chunk) for chunk in chunks]
+
+    quotes = {}
+    for future in futures:
+        try:
+            quotes.update(future.result())
+        except Exception as e:
+            print(f"批次報價請求失敗: {e}")
+    return quotes
+
+
+def get_stock_quotes(stock_codes):
+    """
+    批次獲取多檔即時報價（經報價快取），返回 {代碼: 報價}
+    查無或請求失敗的代碼不會出現在結果中
+    """
+    codes = list(dict.fromkeys(code.strip() for code in stock_codes if code and code.strip()))
+    return quote_cache.get_many(codes, _load_quotes)
+
+
+def _attach_quotes(items):
+    """為清單資料附加即時報價（quote 欄位），整批只發出一輪 MIS 請求"""
+    quotes = get_stock_quotes([item['stock_code'] for item in items])
+    for item in items:
+        item['quote'] = quotes.get(item['stock_code'])
+    return items
+
+
+def get_stock_info(stock_code, history=False, years=5):
+    """
+    獲取即時股票資訊；history=True 時另外附上 years 年 K 線與技術指標
+    """
+    result = get_stock_quote(stock_code)
+    if not history or not result.get('success'):
+        return result
+
+    try:
+        # 獲取歷史數據用於 K 線圖
+        history_data = get_twse_data(stock_code, years=years)
+        if history_data.get('success') and history_data.get('data'):
+            kline_data = []
+            for row in history_data['data']:
+                try:
+                    # TWSE 數據格式: [日期, 成交股數, 成交金額, 開盤價, 最高價, 最低價, 收盤價, 漲跌價差, 成交筆數]
+                    date = row[0].replace('/', '-')
+                    open_price = float(row[3].replace(',', ''))
+                    high_price = float(row[4].replace(',', ''))
+                    low_price = float(row[5].replace(',', ''))
+                    close_price = float(row[6].replace(',', ''))
+                    volume = float(row[1].replace(',', ''))
+
+                    kline_data.append([date, open_price, close_price, low_price, high_price, volume])
+                except (ValueError, IndexError):
+                    continue
+
+            result['kline_data'] = kline_data
+
+            # 技術指標摘要（與 /api/stock/indicators 共用快取結果）
+            if kline_data:
+                try:
+                    result['technical_indicators'] = get_indicator_latest(stock_code, years)
+                except Exception as e:
+                    print(f"計算技術指標失敗: {e}")
+                    result['technical_indicators'] = {}
+
+        return result
+    except Exception as e:
+        return {
+            'success': False,
+            'message': f'錯誤: {str(e)}'
+        }
+
+
+def _arg_flag(args, name):
+    """查詢參數布林值（1/true/yes）"""
+    return args.get(name, '').lower() in ('1', 'true', 'yes')
+
+
+def _parse_history_args(args):
+    """解析 ?history=1&years=N 查詢參數"""
+    history = _arg_flag(args, 'history')
+    try:
+        years = min(max(int(args.get('years', 5)), 1), 10)
+    except ValueError:
+        years = 5
+    return history, years
+
+
+# ========== 技術指標引擎 ==========
+# 指標參數（變更後快取與持久化狀態自動失效）
+INDICATOR_PARAMS = DEFAULT_PARAMS
+INDICATOR_CACHE_MAX_BYTES = int(os.environ.get('INDICATOR_CACHE_MAX_MB', '64')) * 1024 * 1024
+INDICATOR_CACHE_MAX_ENTRIES = int(os.environ.get('INDICATOR_CACHE_MAX_ENTRIES', '512'))
+
+
+def compute_indicator_frame(bars, params=INDICATOR_PARAMS):
+    """
+    以日線 DataFrame 計算完整指標欄位（NumPy kernel），返回新的 DataFrame（不修改 bars）
+    """
+    arrays = [bars[col].to_numpy(dtype='float64') for col in BAR_VALUE_COLUMNS]
+    columns = compute_indicators(*arrays, params)
+    return pd.concat([bars.reset_index(drop=True), pd.DataFrame(columns)], axis=1)
+
+
+def indicator_summary(frame):
+    """
+    取指標最新值（RSI、MACD、布林通道、KD），供即時報價與 AI 分析使用
+    """
+    if frame is None or len(frame) < 20:
+        return {}
+    return _summary_from_values(frame.iloc[-1])
+
+
+def _summary_from_values(last):
+    """由單日指標值（Series 或 dict）組成摘要，略過尚未有值的指標"""
+    columns = {
+        'RSI': 'summary_rsi',
+        'MACD': 'macd',
+        'MACD_SIGNAL': 'macd_signal',
+        'BB_UPPER': 'boll_upper',
+        'BB_MIDDLE': 'boll_middle',
+        'BB_LOWER': 'boll_lower',
+        'KD_K': 'summary_kd_k',
+        'KD_D': 'summary_kd_d',
+    }
+    return {key: float(last[col]) for key, col in columns.items() if pd.notna(last[col])}
+
+
+class IndicatorCache:
+    """
+    指標結果 LRU 快取：每個 (代碼, 年數, 參數) 保留一份，
+    日線指紋（首末日期、筆數、最新收盤）變動時重算；依總記憶體與筆數上限淘汰
+    """
+
+    def __init__(self, max_bytes: int, max_entries: int):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, fingerprint):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == fingerprint:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def peek(self, key):
+        """返回目前快取的結果（不論指紋是否相符），供增量更新使用"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[1] if entry else None
+
+    def put(self, key, fingerprint, frame):
+        size = int(frame.memory_usage(index=True, deep=True).sum())
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self._bytes -= old[2]
+            self._entries[key] = (fingerprint, frame, size)
+            self._bytes += size
+            while self._entries and (self._bytes > self.max_bytes or len(self._entries) > self.max_entries):
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
+indicator_cache = IndicatorCache(INDICATOR_CACHE_MAX_BYTES, INDICATOR_CACHE_MAX_ENTRIES)
+_INDICATOR_PARAMS_KEY = json.dumps(INDICATOR_PARAMS, sort_keys=True)
+
+
+# 指標增量狀態：記憶體保留最新狀態，並寫入 indicator_state 供重啟後沿用
+_indicator_states = {}
+_indicator_locks = {}
+_indicator_locks_guard = threading.Lock()
+_INDICATOR_STATE_VERSION = hashlib.sha1(_INDICATOR_PARAMS_KEY.encode('utf-8')).hexdigest()[:12]
+
+
+def _indicator_lock(key):
+    """同一指標狀態同時只允許一個請求推進"""
+    with _indicator_locks_guard:
+        return _indicator_locks.setdefault(key, threading.Lock())
+
+
+def _state_key(years):
+    return f'{years}y:{_INDICATOR_STATE_VERSION}'
+
+
+def _today_taipei():
+    return datetime.now(TAIPEI_TZ).strftime('%Y-%m-%d')
+
+
+def _save_indicator_state(stock_code, years, state):
+    payload = json.dumps(state.to_dict())
+    with closing(get_conn()) as conn:
+        with closing(conn.cursor()) as cursor:
+            if DB_IS_PG:
+                cursor.execute(
+                    """
+                    INSERT INTO indicator_state (stock_code, state_key, last_date, state, updated_at)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT (stock_code, state_key) DO UPDATE SET
+                        last_date = EXCLUDED.last_date, state = EXCLUDED.state, updated_at = EXCLUDED.updated_at
+                    """,
+                    (stock_code, _state_key(years), state.last_date, payload, time.time())
+                )
+            else:
+                cursor.execute(
+                    'INSERT OR REPLACE INTO indicator_state (stock_code, state_key, last_date, state, updated_at) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (stock_code, _state_key(years), state.last_date, payload, time.time())
+                )
+            conn.commit()
+
+
+def _get_indicator_state(stock_code, years):
+    """取得已確認日線的指標狀態：優先使用記憶體，其次讀取資料庫"""
+    key = (stock_code, years)
+    state = _indicator_states.get(key)
+    if state is not None:
+        return state
+    with closing(get_conn()) as conn:
+        with closing(conn.cursor()) as cursor:
+            cursor.execute(
+                q('SELECT state FROM indicator_state WHERE stock_code = ? AND state_key = ?'),
+                (stock_code, _state_key(years))
+            )
+            row = cursor.fetchone()
+    if not row:
+        return None
+    state = IndicatorState.from_dict(INDICATOR_PARAMS, json.loads(row[0]))
+    _indicator_states[key] = state
+    return state
+
+
+def _rebuild_indicator_state(stock_code, years, bars):
+    """完整重播已確認的日線（不含今日）建立新狀態"""
+    state = IndicatorState(INDICATOR_PARAMS)
+    committed = bars[bars['date'] < _today_taipei()]
+    for bar in committed.itertuples(index=False):
+        state.update(bar.date, bar.open, bar.high, bar.low, bar.close, bar.volume)
+    _indicator_states[(stock_code, years)] = state
+    if state.last_date:
+        _save_indicator_state(stock_code, years, state)
+    return state
+
+
+def _advance_indicator_state(stock_code, years, state, bars):
+    """
+    將狀態推進到 bars 的最後一天：已確認日線（今日以前）寫入狀態，今日日線只在副本上試算
+    狀態最後一天的日線不存在或收盤價不同時視為歷史被修正，返回 None
+    返回 [(日線, 指標值), ...]，只含狀態最後一天之後的日線
+    """
+    anchor = bars[bars['date'] == state.last_date]
+    if anchor.empty or float(anchor['close'].iat[0]) != state.last_close:
+        return None
+
+    today = _today_taipei()
+    rows = []
+    advanced = False
+    for bar in bars[bars['date'] > state.last_date].itertuples(index=False):
+        target = state if bar.date < today else state.copy()
+        values = target.update(bar.date, bar.open, bar.high, bar.low, bar.close, bar.volume)
+        advanced = advanced or target is state
+        rows.append((bar, values))
+    if advanced:
+        _save_indicator_state(stock_code, years, state)
+    return rows
+
+
+def _extend_indicator_frame(stock_code, years, bars):
+    """
+    以上一份快取結果加上增量狀態產生新結果；無法增量（無舊結果、歷史被修正）時返回 None
+    """
+    previous = indicator_cache.peek((stock_code, years, _INDICATOR_PARAMS_KEY))
+    state = _indicator_states.get((stock_code, years))
+    if previous is None or state is None or state.last_date is None:
+        return None
+
+    # 重疊區間的日線須與舊結果完全一致（區間起點可因年數視窗往後移）
+    base = bars[bars['date'] <= state.last_date]
+    kept = previous[(previous['date'] >= bars['date'].iat[0]) & (previous['date'] <= state.last_date)]
+    if (len(kept) != len(base)
+            or not np.array_equal(kept['date'].to_numpy(), base['date'].to_numpy())
+            or not np.array_equal(kept[BAR_VALUE_COLUMNS].to_numpy(), base[BAR_VALUE_COLUMNS].to_numpy(), equal_nan=True)):
+        return None
+
+    rows = _advance_indicator_state(stock_code, years, state, bars)
+    if rows is None:
+        return None
+    appended = pd.DataFrame([{**bar._asdict(), **values} for bar, values in rows], columns=previous.columns)
+    if appended.empty:
+        return kept.reset_index(drop=True)
+    return pd.concat([kept, appended], ignore_index=True)
+
+
+def get_indicator_frame(stock_code, years=5):
+    """
+    返回 years 年日線與完整指標（快取結果，呼叫端不可修改）；無資料時返回空 DataFrame
+    新日線以增量狀態接在上一份結果之後，只有歷史被修正或冷啟動時才完整重算
+    """
+    bars = get_bar_frame(stock_code, years)
+    if bars.empty:
+        return bars
+
+    key = (stock_code, years, _INDICATOR_PARAMS_KEY)
+    fingerprint = (bars['date'].iat[0], bars['date'].iat[-1], len(bars), float(bars['close'].iat[-1]))
+    frame = indicator_cache.get(key, fingerprint)
+    if frame is not None:
+        return frame
+
+    with _indicator_lock((stock_code, years)):
+        frame = _extend_indicator_frame(stock_code, years, bars)
+        if frame is None:
+            frame = compute_indicator_frame(bars)
+            _rebuild_indicator_state(stock_code, years, bars)
+        indicator_cache.put(key, fingerprint, frame)
+    return frame
+
+
+def get_indicator_latest(stock_code, years=5):
+    """
+    返回最新一天的指標摘要：優先使用快取結果，其次以持久化的增量狀態推進，最後才完整計算
+    """
+    bars = get_bar_frame(stock_code, years)
+    if len(bars) < 20:
         return {}
+
+    key = (stock_code, years, _INDICATOR_PARAMS_KEY)
+    fingerprint = (bars['date'].iat[0], bars['date'].iat[-1], len(bars), float(bars['close'].iat[-1]))
+    frame = indicator_cache.get(key, fingerprint)
+    if frame is not None:
+        return indicator_summary(frame)
+
+    # 已有舊結果時交給 get_indicator_frame 增量延伸，以免狀態超前於快取結果
+    if indicator_cache.peek(key) is None:
+        with _indicator_lock((stock_code, years)):
+            state = _get_indicator_state(stock_code, years)
+            if state is not None and state.last_date:
+                rows = _advance_indicator_state(stock_code, years, state, bars)
+                if rows is not None:
+                    return _summary_from_values(rows[-1][1] if rows else state.last_values)
+
+    return indicator_summary(get_indicator_frame(stock_code, years))
+
+
+# ========== 多檔股票批次指標 ==========
+MAX_BATCH_INDICATOR_CODES = 500
+
+
+def load_bar_panel(stock_codes, years=1):
+    """
+    讀取多檔已儲存的日線（不向證交所補抓），對齊為 (日期 × 股票) 的 2-D 陣列
+    停牌或無成交日以前一日收盤價補齊 OHLC、成交量補 0；上市前保持 NaN
+    返回 {'dates', 'codes', 'arrays', 'last_rows'}，無資料時返回 None
+    """
+    first_month = _month_keys(years)[0]
+    since_date = f'{first_month[:4]}-{first_month[4:]}-01'
+    placeholders = ', '.join('?' * len(stock_codes))
+    with closing(get_conn()) as conn:
+        with closing(conn.cursor()) as cursor:
+            cursor.execute(
+                q(f'SELECT stock_code, trade_date, open, high, low, close, volume FROM daily_bars '
+                  f'WHERE stock_code IN ({placeholders}) AND trade_date >= ?'),
+                (*stock_codes, since_date)
+            )
+            rows = cursor.fetchall()
+    if not rows:
+        return None
+
+    bars = pd.DataFrame(rows, columns=['stock_code', 'date'] + BAR_VALUE_COLUMNS)
+    bars[BAR_VALUE_COLUMNS] = bars[BAR_VALUE_COLUMNS].astype('float64')
+    panel = bars.pivot(index='date', columns='stock_code').sort_index()
+    available = set(bars['stock_code'])
+    codes = [code for code in stock_codes if code in available]
+
+    close = panel['close'][codes]
+    traded = close.notna().to_numpy()
+    listed = np.cumsum(traded, axis=0) > 0
+    filled_close = close.ffill()
+    arrays = {'close': filled_close.to_numpy()}
+    for field in ('open', 'high', 'low'):
+        arrays[field] = panel[field][codes].where(close.notna(), filled_close).to_numpy()
+    arrays['volume'] = np.where(listed, panel['volume'][codes].fillna(0).to_numpy(), np.nan)
+
+    # 各股票最後一個實際有成交的日期
+    last_rows = len(traded) - 1 - np.argmax(traded[::-1], axis=0)
+    return {
+        'dates': panel.index.tolist(),
+        'codes': codes,
+        'arrays': arrays,
+        'last_rows': last_rows
+    }
+
+
+def compute_batch_indicators(stock_codes, years=1):
+    """
+    多檔股票一次向量化計算全部指標，返回 {代碼: {date, open, ..., atr}}（各股票最新一天）
+    只使用本地已儲存的日線，未儲存的代碼不在結果中
+    """
+    codes = list(dict.fromkeys(stock_codes))
+    panel = load_bar_panel(codes, years) if codes else None
+    if panel is None:
+        return {}
+
+    arrays = panel['arrays']
+    columns = compute_indicators(*(arrays[field] for field in BAR_VALUE_COLUMNS), INDICATOR_PARAMS)
+    series = {**arrays, **columns}
+
+    cols = np.arange(len(panel['codes']))
+    rows = panel['last_rows']
+    values = np.column_stack([series[name][rows, cols] for name in INDICATOR_SERIES])
+    matrix = values.astype(object)
+    matrix[np.isnan(values)] = None
+
+    latest = {}
+    for j, code in enumerate(panel['codes']):
+        latest[code] = {'date': panel['dates'][rows[j]], **dict(zip(INDICATOR_SERIES, matrix[j].tolist()))}
+    return latest
+
+
+@app.route('/api/indicators/batch', methods=['GET'])
+def get_batch_indicators():
+    """
+    API 端點：多檔股票最新技術指標 ?codes=2330,2317,...&years=1
+    未指定 codes 時使用關注清單中的所有股票
+    """
+    try:
+        codes = [c.strip() for c in request.args.get('codes', '').split(',') if c.strip()]
+        if not codes:
+            codes = WatchlistRepo.codes()
+        if len(codes) > MAX_BATCH_INDICATOR_CODES:
+            return jsonify({'success': False, 'message': f'一次最多計算 {MAX_BATCH_INDICATOR_CODES} 檔股票'})
+
+        years = 1
+        if request.args.get('years'):
+            _, years = _parse_history_args(request.args)
+
+        started = time.perf_counter()
+        data = compute_batch_indicators(codes, years)
+        return jsonify({
+            'success': True,
+            'data': data,
+            'missing': [code for code in dict.fromkeys(codes) if code not in data],
+            'elapsed_ms': round((time.perf_counter() - started) * 1000, 1)
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'計算技術指標失敗: {str(e)}'})
+
+
+# ========== 清單分頁與串流 ==========
+
+def _parse_page_args(args):
+    """
+    解析 ?after=<時間,id>&limit=&format=，格式錯誤時拋出 ValueError
+    未帶 after/limit 時不分頁（保持原本的完整清單回應）
+    """
+    after = None
+    raw_after = args.get('after', '').strip()
+    if raw_after:
+        stamp, _, row_id = raw_after.rpartition(',')
+        if not stamp or not row_id.isdigit():
+            raise ValueError('after 格式應為 <時間,id>')
+        after = (stamp, int(row_id))
+
+    limit = None
+    raw_limit = args.get('limit', '').strip()
+    if raw_limit:
+        if not raw_limit.isdigit() or int(raw_limit) < 1:
+            raise ValueError('limit 必須為正整數')
+        limit = min(int(raw_limit), MAX_PAGE_SIZE)
+
+    fmt = args.get('format', 'json').strip().lower()
+    paginated = after is not None or limit is not None
+    if paginated and limit is None and fmt != 'ndjson':
+        limit = DEFAULT_PAGE_SIZE
+    return {'after': after, 'limit': limit, 'format': fmt, 'paginated': paginated}
+
+
+def _ndjson_response(batches, with_quotes=False):
+    """將逐批產生的資料以 NDJSON（每行一筆 JSON）串流回應"""
+    def generate():
+        for rows in batches:
+            if with_quotes:
+                _attach_quotes(rows)
+            yield ''.join(json.dumps(row, ensure_ascii=False, default=str) + '\n' for row in rows)
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+def _favorite_item(row):
+    return {'stock_code': row['stock_code'], 'stock_name': row.get('stock_name', '')}
+
+
 @app.route('/api/watchlist', methods=['GET'])
 def get_watchlist():
     """
     API 端點：獲取關注清單
+    ?after=<added_time,id>&limit= 分頁；?format=ndjson 逐行串流
     """
     try:
         category = request.args.get('category', '')
-        with closing(get_conn()) as conn:
-            if not DB_IS_PG:
-                conn.row_factory = sqlite3.Row
-            with closing(conn.cursor(row_factory=dict_row) if DB_IS_PG else conn.cursor()) as cursor:
-                if category:
-                    cursor.execute(q('SELECT * FROM watchlist WHERE category = ? ORDER BY added_time DESC'), (category,))
-                else:
-                    cursor.execute('SELECT * FROM watchlist ORDER BY added_time DESC')
-                
-                rows = cursor.fetchall()
-                if DB_IS_PG:
-                    watchlist = rows
-                else:
-                    watchlist = [dict(row) for row in rows]
-                
-        return jsonify({'success': True, 'data': watchlist})
+        with_quotes = _arg_flag(request.args, 'quotes')
+        page = _parse_page_args(request.args)
+
+        if page['format'] == 'ndjson':
+            batches = WatchlistRepo.stream(category or None, page['after'], page['limit'])
+            return _ndjson_response(batches, with_quotes)
+
+        next_cursor = None
+        if page['paginated']:
+            watchlist = WatchlistRepo.page(category or None, page['after'], page['limit'])
+            if len(watchlist) == page['limit']:
+                next_cursor = WatchlistRepo.PAGES.cursor_of(watchlist[-1])
+        else:
+            watchlist = WatchlistRepo.list(category)
+
+        # ?quotes=1 時附上即時報價
+        if with_quotes:
+            _attach_quotes(watchlist)
+
+        result = {'success': True, 'data': watchlist}
+        if page['paginated']:
+            result['next_cursor'] = next_cursor
+        return jsonify(result)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
@@ -464,20 +2147,12 @@ def add_to_watchlist():
             return jsonify({'success': False, 'message': '股票代碼和分類不能為空'})
         
         # 獲取股票名稱
-        stock_info = get_stock_info(stock_code)
-        stock_name = stock_info.get('stock_name', '') if stock_info.get('success') else ''
+        stock_name = get_stock_name(stock_code)
         
-        with closing(get_conn()) as conn:
-            with closing(conn.cursor(row_factory=dict_row) if DB_IS_PG else conn.cursor()) as cursor:
-                # 檢查是否已存在
-                cursor.execute(q('SELECT id FROM watchlist WHERE stock_code = ?'), (stock_code,))
-                if cursor.fetchone():
-                    return jsonify({'success': False, 'message': '此股票已在關注清單中'})
-                
-                # 添加到資料庫
-                cursor.execute(q('INSERT INTO watchlist (stock_code, stock_name, category) VALUES (?, ?, ?)'), (stock_code, stock_name, category))
-                conn.commit()
-                
+        # 代碼唯一，已存在時不會寫入
+        if not WatchlistRepo.add(stock_code, stock_name, category):
+            return jsonify({'success': False, 'message': '此股票已在關注清單中'})
+
         return jsonify({'success': True, 'message': '已成功添加到關注清單'})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
@@ -488,29 +2163,149 @@ def delete_from_watchlist(id):
     API 端點：從關注清單刪除股票
     """
     try:
-        with closing(get_conn()) as conn:
-            with closing(conn.cursor(row_factory=dict_row) if DB_IS_PG else conn.cursor()) as cursor:
-                cursor.execute(q('DELETE FROM watchlist WHERE id = ?'), (id,))
-                conn.commit()
-                
+        WatchlistRepo.delete(id)
+
         return jsonify({'success': True, 'message': '已從關注清單移除'})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
+# ========== 查詢歷史寫入緩衝 ==========
+SEARCH_HISTORY_LIMIT = 50
+SEARCH_HISTORY_BATCH_SIZE = int(os.environ.get('SEARCH_HISTORY_BATCH_SIZE', '100'))
+SEARCH_HISTORY_FLUSH_INTERVAL = float(os.environ.get('SEARCH_HISTORY_FLUSH_INTERVAL', '2'))
+SEARCH_HISTORY_MAX_PENDING = int(os.environ.get('SEARCH_HISTORY_MAX_PENDING', '10000'))
+SEARCH_HISTORY_MAX_ROWS = int(os.environ.get('SEARCH_HISTORY_MAX_ROWS', '10000'))
+SEARCH_HISTORY_PRUNE_INTERVAL = float(os.environ.get('SEARCH_HISTORY_PRUNE_INTERVAL', '600'))
+
+
+def _search_timestamp():
+    """與資料庫 CURRENT_TIMESTAMP 相同格式的目前時間（UTC）"""
+    now = datetime.now(timezone.utc)
+    return now if DB_IS_PG else now.strftime('%Y-%m-%d %H:%M:%S')
+
+
+class SearchHistoryWriter:
+    """
+    查詢歷史寫入緩衝：請求只放進記憶體佇列，由背景執行緒依筆數或時間間隔整批寫入
+    連續查詢同一檔股票只更新時間；寫入後定期刪除超出保留筆數的舊資料
+    """
+
+    def __init__(self, batch_size, interval, max_pending):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending = []
+        self._inflight = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = None
+        self._last_prune = 0.0
+        self.flushed = 0
+        self.batches = 0
+        self.failures = 0
+        self.dropped = 0
+
+    def _ensure_worker(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='search-history-writer', daemon=True)
+            self._thread.start()
+
+    def add(self, stock_code, stock_name):
+        now = _search_timestamp()
+        full = False
+        with self._lock:
+            stopped = self._stopped
+            if not stopped:
+                self._ensure_worker()
+                last = self._pending[-1] if self._pending else None
+                if last and last['stock_code'] == stock_code:
+                    last['stock_name'] = stock_name or last['stock_name']
+                    last['search_time'] = now
+                else:
+                    self._pending.append({'id': None, 'stock_code': stock_code, 'stock_name': stock_name, 'search_time': now})
+                    if len(self._pending) > self.max_pending:
+                        del self._pending[0]
+                        self.dropped += 1
+                full = len(self._pending) >= self.batch_size
+        if stopped:
+            # 關閉後的寫入直接落盤
+            SearchHistoryRepo.add_many([(stock_code, stock_name, now)])
+        elif full:
+            self._wake.set()
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"寫入查詢歷史失敗: {e}")
+
+    def flush(self):
+        """把目前佇列整批寫入；失敗時放回佇列等下次重試"""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+                self._inflight = batch
+            if batch:
+                try:
+                    SearchHistoryRepo.add_many([(r['stock_code'], r['stock_name'], r['search_time']) for r in batch])
+                except Exception:
+                    with self._lock:
+                        self._pending = (batch + self._pending)[-self.max_pending:]
+                        self._inflight = []
+                        self.failures += 1
+                    raise
+                with self._lock:
+                    self._inflight = []
+                    self.flushed += len(batch)
+                    self.batches += 1
+
+            if time.time() - self._last_prune >= SEARCH_HISTORY_PRUNE_INTERVAL:
+                self._last_prune = time.time()
+                SearchHistoryRepo.prune(SEARCH_HISTORY_MAX_ROWS)
+
+    def recent(self, limit):
+        """最新的查詢歷史：尚未寫入的資料加上資料庫中的資料"""
+        with self._flush_lock:
+            rows = SearchHistoryRepo.recent(limit)
+            with self._lock:
+                pending = list(reversed(self._pending))
+        return (pending + rows)[:limit]
+
+    def close(self):
+        with self._lock:
+            self._stopped = True
+        self._wake.set()
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': len(self._pending),
+                'flushed': self.flushed,
+                'batches': self.batches,
+                'failures': self.failures,
+                'dropped': self.dropped
+            }
+
+
+search_history_writer = SearchHistoryWriter(
+    SEARCH_HISTORY_BATCH_SIZE, SEARCH_HISTORY_FLUSH_INTERVAL, SEARCH_HISTORY_MAX_PENDING
+)
+atexit.register(search_history_writer.close)
+
+
 @app.route('/api/history', methods=['GET'])
 def get_search_history():
     """
     API 端點：獲取查詢歷史
     """
     try:
-        with closing(get_conn()) as conn:
-            if not DB_IS_PG:
-                conn.row_factory = sqlite3.Row
-            with closing(conn.cursor(row_factory=dict_row) if DB_IS_PG else conn.cursor()) as cursor:
-                cursor.execute('SELECT * FROM search_history ORDER BY search_time DESC LIMIT 50')
-                rows = cursor.fetchall()
-                history = rows if DB_IS_PG else [dict(row) for row in rows]
-                
+        history = search_history_writer.recent(SEARCH_HISTORY_LIMIT)
         return jsonify({'success': True, 'data': history})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
@@ -518,7 +2313,7 @@ def get_search_history():
 @app.route('/api/history', methods=['POST'])
 def add_search_history():
     """
-    API 端點：添加查詢歷史
+    API 端點：添加查詢歷史（緩衝後整批寫入）
     """
     try:
         data = request.json
@@ -528,11 +2323,7 @@ def add_search_history():
         if not stock_code:
             return jsonify({'success': False, 'message': '股票代碼不能為空'})
         
-        with closing(get_conn()) as conn:
-            with closing(conn.cursor(row_factory=dict_row) if DB_IS_PG else conn.cursor()) as cursor:
-                cursor.execute(q('INSERT INTO search_history (stock_code, stock_name) VALUES (?, ?)'), (stock_code, stock_name))
-                conn.commit()
-                
+        search_history_writer.add(stock_code, stock_name)
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
@@ -569,8 +2360,7 @@ def get_stock_news(stock_code):
         news_list = []
         
         # 獲取股票名稱
-        stock_info = get_stock_info(stock_code)
-        stock_name = stock_info.get('stock_name', stock_code) if stock_info.get('success') else stock_code
+        stock_name = get_stock_name(stock_code) or stock_code
         
         # Google News RSS (台股新聞)
         search_term = f"{stock_code} {stock_name} 台股"
@@ -697,121 +2487,108 @@ def test_page():
 def get_stock(stock_code):
     """
     API 端點：獲取股票即時資訊
+    加上 ?history=1&years=N 時一併返回 K 線與技術指標
     """
-    result = get_stock_info(stock_code)
+    history, years = _parse_history_args(request.args)
+    result = get_stock_info(stock_code, history=history, years=years)
     return jsonify(result)
 
+@app.route('/api/stocks/quotes')
+def get_batch_quotes():
+    """
+    API 端點：批次獲取多檔即時報價 ?codes=2330,2317,...
+    """
+    codes = [c.strip() for c in request.args.get('codes', '').split(',') if c.strip()]
+    if not codes:
+        return jsonify({'success': False, 'message': '需要 codes 參數'})
+    if len(codes) > MAX_BATCH_QUOTE_CODES:
+        return jsonify({'success': False, 'message': f'一次最多查詢 {MAX_BATCH_QUOTE_CODES} 檔股票'})
+
+    quotes = get_stock_quotes(codes)
+    return jsonify({
+        'success': True,
+        'data': quotes,
+        'missing': [code for code in dict.fromkeys(codes) if code not in quotes]
+    })
+
 @app.route('/api/stock/history/<stock_code>')
 def get_stock_history(stock_code):
     """
-    API 端點：獲取股票歷史資料
+    API 端點：獲取股票歷史資料（?years=N，預設 5 年）
     """
-    result = get_twse_data(stock_code)
+    _, years = _parse_history_args(request.args)
+    result = get_twse_data(stock_code, years=years)
     return jsonify(result)
 
 
+# /api/stock/indicators 返回的數值序列（順序即回應欄位順序）
+INDICATOR_SERIES = [
+    'open', 'high', 'low', 'close', 'volume',
+    'ma5', 'ma10', 'ma20', 'ma60',
+    'rsi6', 'rsi12',
+    'macd', 'macd_signal', 'macd_hist',
+    'boll_upper', 'boll_middle', 'boll_lower',
+    'kd_k', 'kd_d',
+    'volume_ma5', 'volume_ma10',
+    'atr'
+]
+
+
+def _nullable_matrix(df, columns):
+    """數值欄位整批轉為 Python 物件矩陣，NaN 一次性換成 None（JSON null）"""
+    values = df[columns].to_numpy(dtype='float64')
+    matrix = values.astype(object)
+    matrix[np.isnan(values)] = None
+    return matrix
+
+
+def indicator_records(df):
+    """逐日列格式：[{date, open, ..., atr}, ...]"""
+    keys = ['date'] + INDICATOR_SERIES
+    matrix = _nullable_matrix(df, INDICATOR_SERIES)
+    return [dict(zip(keys, (date, *row))) for date, row in zip(df['date'].tolist(), matrix.tolist())]
+
+
+def indicator_columns(df):
+    """欄位格式：{date: [...], open: [...], ...}"""
+    matrix = _nullable_matrix(df, INDICATOR_SERIES)
+    columns = {'date': df['date'].tolist()}
+    for i, name in enumerate(INDICATOR_SERIES):
+        columns[name] = matrix[:, i].tolist()
+    return columns
+
+
 @app.route('/api/stock/indicators/<stock_code>')
 def get_stock_indicators(stock_code):
     """
-    API 端點：使用 ta 庫計算技術指標
+    API 端點：計算技術指標（?years=N，預設 5 年）
     返回 K 線數據 + MA + RSI + MACD + BOLL 等指標
     """
-    if not TALIB_AVAILABLE:
-        return jsonify({
-            'success': False,
-            'message': 'ta library not installed'
-        })
-    
     try:
-        # 獲取原始歷史數據
-        raw_data = get_twse_data(stock_code)
-        if not raw_data.get('success') or not raw_data.get('data'):
-            return jsonify(raw_data)
+        _, years = _parse_history_args(request.args)
+        df = get_indicator_frame(stock_code, years)
+        if df.empty:
+            return jsonify({
+                'success': False,
+                'message': '查無此股票代碼或資料尚未更新'
+            })
         
-        data = raw_data['data']
-        if len(data) < 60:  # 至少需要 60 天數據計算 MA60
+        if len(df) < 60:  # 至少需要 60 天數據計算 MA60
             return jsonify({
                 'success': False,
                 'message': '歷史數據不足 (需要至少 60 天)'
             })
         
-        # 轉換為 DataFrame
-        df = pd.DataFrame(data, columns=['date', 'volume', 'amount', 'open', 'high', 'low', 'close'])
-        df['open'] = pd.to_numeric(df['open'], errors='coerce')
-        df['high'] = pd.to_numeric(df['high'], errors='coerce')
-        df['low'] = pd.to_numeric(df['low'], errors='coerce')
-        df['close'] = pd.to_numeric(df['close'], errors='coerce')
-        df['volume'] = pd.to_numeric(df['volume'], errors='coerce')
-        
-        # 計算技術指標
-        # 1. 移動平均線 (MA)
-        df['ma5'] = ta.trend.sma_indicator(df['close'], window=5)
-        df['ma10'] = ta.trend.sma_indicator(df['close'], window=10)
-        df['ma20'] = ta.trend.sma_indicator(df['close'], window=20)
-        df['ma60'] = ta.trend.sma_indicator(df['close'], window=60)
-        
-        # 2. RSI 相對強弱指標
-        df['rsi6'] = ta.momentum.rsi(df['close'], window=6)
-        df['rsi12'] = ta.momentum.rsi(df['close'], window=12)
-        
-        # 3. MACD 指標
-        macd_indicator = ta.trend.MACD(df['close'], window_slow=26, window_fast=12, window_sign=9)
-        df['macd'] = macd_indicator.macd()
-        df['macd_signal'] = macd_indicator.macd_signal()
-        df['macd_hist'] = macd_indicator.macd_diff()
-        
-        # 4. 布林通道 (Bollinger Bands)
-        bollinger = ta.volatility.BollingerBands(df['close'], window=20, window_dev=2)
-        df['boll_upper'] = bollinger.bollinger_hband()
-        df['boll_middle'] = bollinger.bollinger_mavg()
-        df['boll_lower'] = bollinger.bollinger_lband()
-        
-        # 5. KD 指標 (Stochastic)
-        stoch = ta.momentum.StochasticOscillator(df['high'], df['low'], df['close'], window=9, smooth_window=3)
-        df['kd_k'] = stoch.stoch()
-        df['kd_d'] = stoch.stoch_signal()
-        
-        # 6. 成交量移動平均
-        df['volume_ma5'] = ta.trend.sma_indicator(df['volume'], window=5)
-        df['volume_ma10'] = ta.trend.sma_indicator(df['volume'], window=10)
-        
-        # 7. ATR 真實波動幅度均值
-        df['atr'] = ta.volatility.average_true_range(df['high'], df['low'], df['close'], window=14)
-        
-        # 組裝返回數據
-        indicators = []
-        for _, row in df.iterrows():
-            indicators.append({
-                'date': row['date'],
-                'open': float(row['open']) if pd.notna(row['open']) else None,
-                'high': float(row['high']) if pd.notna(row['high']) else None,
-                'low': float(row['low']) if pd.notna(row['low']) else None,
-                'close': float(row['close']) if pd.notna(row['close']) else None,
-                'volume': float(row['volume']) if pd.notna(row['volume']) else None,
-                'ma5': float(row['ma5']) if pd.notna(row['ma5']) else None,
-                'ma10': float(row['ma10']) if pd.notna(row['ma10']) else None,
-                'ma20': float(row['ma20']) if pd.notna(row['ma20']) else None,
-                'ma60': float(row['ma60']) if pd.notna(row['ma60']) else None,
-                'rsi6': float(row['rsi6']) if pd.notna(row['rsi6']) else None,
-                'rsi12': float(row['rsi12']) if pd.notna(row['rsi12']) else None,
-                'macd': float(row['macd']) if pd.notna(row['macd']) else None,
-                'macd_signal': float(row['macd_signal']) if pd.notna(row['macd_signal']) else None,
-                'macd_hist': float(row['macd_hist']) if pd.notna(row['macd_hist']) else None,
-                'boll_upper': float(row['boll_upper']) if pd.notna(row['boll_upper']) else None,
-                'boll_middle': float(row['boll_middle']) if pd.notna(row['boll_middle']) else None,
-                'boll_lower': float(row['boll_lower']) if pd.notna(row['boll_lower']) else None,
-                'kd_k': float(row['kd_k']) if pd.notna(row['kd_k']) else None,
-                'kd_d': float(row['kd_d']) if pd.notna(row['kd_d']) else None,
-                'volume_ma5': float(row['volume_ma5']) if pd.notna(row['volume_ma5']) else None,
-                'volume_ma10': float(row['volume_ma10']) if pd.notna(row['volume_ma10']) else None,
-                'atr': float(row['atr']) if pd.notna(row['atr']) else None
-            })
+        # 組裝返回數據：?format=columns 時每個序列各為一個陣列
+        fmt = 'columns' if request.args.get('format') == 'columns' else 'rows'
+        series = indicator_columns(df) if fmt == 'columns' else indicator_records(df)
         
         return jsonify({
             'success': True,
             'stock_code': stock_code,
-            'data': indicators,
-            'count': len(indicators)
+            'format': fmt,
+            'data': series,
+            'count': len(df)
         })
         
     except Exception as e:
@@ -844,38 +2621,20 @@ def register_user():
         
         with closing(get_conn()) as conn:
             print(f"[DEBUG] 數據庫連接成功, DB_IS_PG={DB_IS_PG}")
-            with closing(conn.cursor(row_factory=dict_row) if DB_IS_PG else conn.cursor()) as cursor:
-                # 檢查是否已存在
-                cursor.execute(q('SELECT id FROM users WHERE user_id = ?'), (user_id,))
-                existing = cursor.fetchone()
-                print(f"[DEBUG] 檢查用戶是否存在: {existing}")
-                if existing:
-                    return jsonify({'success': False, 'message': '此使用者 ID 已被註冊'})
-                
-                # 檢查是否為第一個使用者（管理員）
-                cursor.execute('SELECT COUNT(*) as cnt FROM users')
-                count_row = cursor.fetchone()
-                is_first_user = False
-                if DB_IS_PG:
-                    is_first_user = (count_row.get('cnt', 0) == 0)
-                else:
-                    is_first_user = (count_row[0] == 0)
-                
-                print(f"[DEBUG] 用戶計數: {count_row}, is_first_user={is_first_user}")
-                
-                # 插入新使用者
-                if DB_IS_PG:
-                    cursor.execute(
-                        q('INSERT INTO users (user_id, password_hash, is_admin) VALUES (?, ?, ?)'),
-                        (user_id, password_hash, is_first_user)
-                    )
-                else:
-                    cursor.execute(
-                        q('INSERT INTO users (user_id, password_hash, is_admin) VALUES (?, ?, ?)'),
-                        (user_id, password_hash, 1 if is_first_user else 0)
-                    )
-                conn.commit()
-                print(f"[DEBUG] 用戶註冊成功: {user_id}")
+            # 檢查是否已存在
+            existing = UsersRepo.get(user_id, conn)
+            print(f"[DEBUG] 檢查用戶是否存在: {existing is not None}")
+            if existing:
+                return jsonify({'success': False, 'message': '此使用者 ID 已被註冊'})
+
+            # 檢查是否為第一個使用者（管理員）
+            user_count = UsersRepo.count(conn)
+            is_first_user = user_count == 0
+            print(f"[DEBUG] 用戶計數: {user_count}, is_first_user={is_first_user}")
+
+            # 插入新使用者
+            UsersRepo.create(user_id, password_hash, is_first_user, conn)
+            print(f"[DEBUG] 用戶註冊成功: {user_id}")
         
         return jsonify({
             'success': True,
@@ -904,27 +2663,21 @@ def login_user():
         
         password_hash = hash_password(password)
         
-        with closing(get_conn()) as conn:
-            if not DB_IS_PG:
-                conn.row_factory = sqlite3.Row
-            with closing(conn.cursor(row_factory=dict_row) if DB_IS_PG else conn.cursor()) as cursor:
-                cursor.execute(q('SELECT * FROM users WHERE user_id = ?'), (user_id,))
-                row = cursor.fetchone()
-                
-                print(f"[DEBUG] 查詢用戶結果: {row}")
-                
-                if not row:
-                    return jsonify({'success': False, 'message': '使用者不存在'})
-                
-                stored_hash = row['password_hash'] if DB_IS_PG else row['password_hash']
-                print(f"[DEBUG] stored_hash={stored_hash[:20]}..., input_hash={password_hash[:20]}...")
-                
-                if stored_hash != password_hash:
-                    return jsonify({'success': False, 'message': '密碼錯誤'})
-                
-                is_admin = row.get('is_admin', False) if DB_IS_PG else bool(row['is_admin'])
-                print(f"[DEBUG] 登入成功: {user_id}, is_admin={is_admin}")
-                
+        row = UsersRepo.get(user_id)
+        print(f"[DEBUG] 查詢用戶結果: {row is not None}")
+
+        if not row:
+            return jsonify({'success': False, 'message': '使用者不存在'})
+
+        stored_hash = row['password_hash']
+        print(f"[DEBUG] stored_hash={stored_hash[:20]}..., input_hash={password_hash[:20]}...")
+
+        if stored_hash != password_hash:
+            return jsonify({'success': False, 'message': '密碼錯誤'})
+
+        is_admin = row['is_admin']
+        print(f"[DEBUG] 登入成功: {user_id}, is_admin={is_admin}")
+
         return jsonify({
             'success': True,
             'user_id': user_id,
@@ -946,111 +2699,837 @@ def get_favorites():
         if not user_id:
             return jsonify({'success': False, 'message': '需要 user_id'})
         
-        # 檢查是否為管理員
+        with_quotes = _arg_flag(request.args, 'quotes')
+        page = _parse_page_args(request.args)
         is_admin = check_user_is_admin(user_id)
-        
-        with closing(get_conn()) as conn:
-            if not DB_IS_PG:
-                conn.row_factory = sqlite3.Row
-            with closing(conn.cursor(row_factory=dict_row) if DB_IS_PG else conn.cursor()) as cursor:
-                if is_admin:
-                    # 管理員可查看所有使用者的最愛
-                    cursor.execute('SELECT * FROM favorites ORDER BY user_id, liked_time DESC')
-                else:
-                    # 一般使用者只能看自己的
-                    cursor.execute(q('SELECT * FROM favorites WHERE user_id = ? ORDER BY liked_time DESC'), (user_id,))
-                rows = cursor.fetchall()
-                data = rows if DB_IS_PG else [dict(r) for r in rows]
-        
+        # 管理員可查看所有使用者的最愛，一般使用者只能看自己的
+        scope = None if is_admin else user_id
+
+        if page['format'] == 'ndjson':
+            batches = FavoritesRepo.stream(scope, page['after'], page['limit'])
+            return _ndjson_response(
+                ([_favorite_item(row) for row in rows] for rows in batches), with_quotes
+            )
+
+        next_cursor = None
+        if page['paginated']:
+            data = FavoritesRepo.page(scope, page['after'], page['limit'])
+            if len(data) == page['limit']:
+                next_cursor = FavoritesRepo.PAGES.cursor_of(data[-1])
+        else:
+            data = FavoritesRepo.list(scope)
+
         # 返回簡化格式
-        favorites = [{'stock_code': row['stock_code'], 'stock_name': row.get('stock_name', '')} for row in data]
-        return jsonify({'success': True, 'favorites': favorites, 'is_admin': is_admin})
+        favorites = [_favorite_item(row) for row in data]
+        # ?quotes=1 時附上即時報價
+        if with_quotes:
+            _attach_quotes(favorites)
+        result = {'success': True, 'favorites': favorites, 'is_admin': is_admin}
+        if page['paginated']:
+            result['next_cursor'] = next_cursor
+        return jsonify(result)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+
+@app.route('/api/favorites', methods=['POST'])
+def add_favorite():
+    try:
+        data = request.json or {}
+        user_id = (data.get('user_id') or '').strip()
+        stock_code = (data.get('stock_code') or '').strip()
+        if not user_id or not stock_code:
+            return jsonify({'success': False, 'message': 'user_id 與 stock_code 不能為空'})
+
+        # 查股票名稱
+        stock_name = get_stock_name(stock_code)
+
+        FavoritesRepo.add(user_id, stock_code, stock_name)
+        return jsonify({'success': True})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+
+MAX_BULK_FAVORITES = 1000
+
+
+@app.route('/api/favorites/bulk', methods=['POST'])
+def add_favorites_bulk():
+    """
+    API 端點：一次匯入多檔最愛 {user_id, stock_codes: [...]}，整批一個交易
+    """
+    try:
+        data = request.json or {}
+        user_id = (data.get('user_id') or '').strip()
+        codes = data.get('stock_codes') or []
+        if isinstance(codes, str):
+            codes = codes.split(',')
+        codes = list(dict.fromkeys(str(code).strip() for code in codes if str(code).strip()))
+        if not user_id or not codes:
+            return jsonify({'success': False, 'message': 'user_id 與 stock_codes 不能為空'})
+        if len(codes) > MAX_BULK_FAVORITES:
+            return jsonify({'success': False, 'message': f'一次最多匯入 {MAX_BULK_FAVORITES} 檔股票'})
+
+        FavoritesRepo.add_many(user_id, get_stock_names(codes))
+        return jsonify({'success': True, 'count': len(codes)})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+
+@app.route('/api/favorites/last', methods=['GET'])
+def get_last_favorite():
+    try:
+        user_id = request.args.get('user_id', '').strip()
+        if not user_id:
+            return jsonify({'success': False, 'message': '需要 user_id'})
+        data = FavoritesRepo.last(user_id)
+        return jsonify({'success': True, 'data': data})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+
+@app.route('/api/favorites/<int:fav_id>', methods=['DELETE'])
+def delete_favorite(fav_id: int):
+    try:
+        user_id = request.args.get('user_id', '').strip()
+        FavoritesRepo.delete(fav_id, user_id)
+        return jsonify({'success': True})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+
+@app.route('/api/favorites/<stock_code>', methods=['DELETE'])
+def delete_favorite_by_code(stock_code: str):
+    try:
+        user_id = request.args.get('user_id', '').strip()
+        if not user_id:
+            return jsonify({'success': False, 'message': '需要 user_id'})
+
+        FavoritesRepo.delete_code(user_id, stock_code)
+        return jsonify({'success': True})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
 
-@app.route('/api/favorites', methods=['POST'])
-def add_favorite():
+# ========== AI 提供者註冊表 ==========
+LLM_CONNECT_TIMEOUT = float(os.environ.get('LLM_CONNECT_TIMEOUT', '5'))
+# OpenAI 單次請求逾時；Ollama 載入模型可能很久，只限制連線時間
+LLM_HTTP_TIMEOUT = float(os.environ.get('LLM_HTTP_TIMEOUT', '120'))
+LLM_HTTP_MAX_CONNECTIONS = int(os.environ.get('LLM_HTTP_MAX_CONNECTIONS', '10'))
+# 連續失敗達門檻後暫停選用，冷卻結束再給一次機會
+PROVIDER_FAILURE_THRESHOLD = int(os.environ.get('PROVIDER_FAILURE_THRESHOLD', '3'))
+PROVIDER_COOLDOWN = float(os.environ.get('PROVIDER_COOLDOWN', '60'))
+PROVIDER_LATENCY_ALPHA = 0.3
+
+PROVIDER_NAMES = {
+    'ollama': 'Ollama (本地)',
+    'openai': 'OpenAI GPT',
+    'gemini': 'Google Gemini'
+}
+
+
+def _http_limits():
+    import httpx  # ollama 與 openai 皆依賴 httpx
+    return httpx, httpx.Limits(max_connections=LLM_HTTP_MAX_CONNECTIONS,
+                               max_keepalive_connections=LLM_HTTP_MAX_CONNECTIONS)
+
+
+class ProviderRegistry:
+    """
+    長駐的 AI 客戶端（共用 HTTP 連線池）與各提供者的健康狀態、延遲
+    select() 依連續失敗次數與量測到的首個 token 時間排序可用提供者，尚未量測的先試一次
+    """
+
+    def __init__(self, providers):
+        # 預設順序只在延遲相同或都未量測時決定先後
+        self.providers = providers
+        self._lock = threading.Lock()
+        self._ollama = None
+        self._openai = None
+        self._gemini_models = {}
+        self._health = {
+            provider: {'requests': 0, 'failures': 0, 'consecutive_failures': 0,
+                       'latency': None, 'last_error': None, 'down_since': None}
+            for provider in providers
+        }
+
+    def ollama(self):
+        with self._lock:
+            if self._ollama is None:
+                httpx, limits = _http_limits()
+                self._ollama = ollama.Client(
+                    host=OLLAMA_HOST,
+                    timeout=httpx.Timeout(None, connect=LLM_CONNECT_TIMEOUT),
+                    limits=limits
+                )
+            return self._ollama
+
+    def openai(self):
+        with self._lock:
+            if self._openai is None:
+                httpx, limits = _http_limits()
+                self._openai = openai.OpenAI(
+                    api_key=OPENAI_API_KEY,
+                    timeout=httpx.Timeout(LLM_HTTP_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+                    http_client=httpx.Client(limits=limits)
+                )
+            return self._openai
+
+    def gemini_model(self, model):
+        with self._lock:
+            if model not in self._gemini_models:
+                self._gemini_models[model] = genai.GenerativeModel(model)
+            return self._gemini_models[model]
+
+    def record(self, provider, ttft, failed, error=None):
+        """每次請求結束時呼叫；ttft 為秒，失敗時不更新延遲"""
+        with self._lock:
+            item = self._health.get(provider)
+            if item is None:
+                return
+            item['requests'] += 1
+            if failed:
+                item['failures'] += 1
+                item['consecutive_failures'] += 1
+                item['last_error'] = str(error) if error else None
+                if item['consecutive_failures'] >= PROVIDER_FAILURE_THRESHOLD:
+                    item['down_since'] = time.time()
+                return
+            item['consecutive_failures'] = 0
+            item['down_since'] = None
+            if ttft is not None:
+                item['latency'] = ttft if item['latency'] is None else (
+                    PROVIDER_LATENCY_ALPHA * ttft + (1 - PROVIDER_LATENCY_ALPHA) * item['latency'])
+
+    def _healthy(self, item):
+        return item['down_since'] is None or time.time() - item['down_since'] >= PROVIDER_COOLDOWN
+
+    def select(self, preferred=None):
+        """
+        返回依序嘗試的可用提供者清單：健康者在前，再依連續失敗次數由少到多，
+        同樣次數時未量測者先、其餘依延遲由低到高；失敗不產生延遲樣本，
+        先比失敗次數才不會讓一直失敗的提供者因「未量測」而排在最前面
+        preferred 若可用則固定排第一
+        """
+        with self._lock:
+            ranked = sorted(
+                (p for p in self.providers if llm_provider_ready(p)),
+                key=lambda p: (
+                    not self._healthy(self._health[p]),
+                    self._health[p]['consecutive_failures'],
+                    self._health[p]['latency'] is not None,
+                    self._health[p]['latency'] or 0.0,
+                    self.providers.index(p)
+                )
+            )
+        if preferred in ranked:
+            ranked.remove(preferred)
+            ranked.insert(0, preferred)
+        return ranked
+
+    def stats(self):
+        with self._lock:
+            return {
+                provider: {
+                    'ready': llm_provider_ready(provider),
+                    'healthy': self._healthy(item),
+                    'requests': item['requests'],
+                    'failures': item['failures'],
+                    'consecutive_failures': item['consecutive_failures'],
+                    'latency_ms': round(item['latency'] * 1000, 1) if item['latency'] is not None else None,
+                    'last_error': item['last_error']
+                }
+                for provider, item in self._health.items()
+            }
+
+
+provider_registry = ProviderRegistry(('ollama', 'openai', 'gemini'))
+
+
+# ========== 提示詞建構 ==========
+# 提示詞（含 system）的 token 上限；超過時從優先度最低的內容開始捨棄
+PROMPT_TOKEN_BUDGET = int(os.environ.get('PROMPT_TOKEN_BUDGET', '800'))
+# 新聞標題最多保留的字數與則數
+PROMPT_NEWS_TITLE_CHARS = 40
+PROMPT_NEWS_ITEMS = 3
+# 未安裝 tiktoken 時的粗估：每個中日韓字約當的 token 數，其餘文字約 4 個字元一個 token
+PROMPT_CJK_TOKEN_RATIO = {
+    'openai': 1.0,
+    'gemini': 0.8,
+    'ollama': 1.5
+}
+_CJK_PATTERN = re.compile(r'[\u2e80-\u9fff\uf900-\ufaff\uff00-\uffef]')
+_PROMPT_EMPTY_VALUES = ('', 'N/A', '資料擷取中')
+_tiktoken_encodings = {}
+
+
+def _tiktoken_encoding(model):
+    if model not in _tiktoken_encodings:
+        try:
+            _tiktoken_encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _tiktoken_encodings[model] = tiktoken.get_encoding('cl100k_base')
+    return _tiktoken_encodings[model]
+
+
+def count_tokens(text, provider, model=None):
+    """估算 text 在該提供者的 token 數；OpenAI 且安裝 tiktoken 時精確計算"""
+    if provider == 'openai' and TIKTOKEN_AVAILABLE:
+        return len(_tiktoken_encoding(model or LLM_DEFAULT_MODELS['openai']).encode(text))
+    cjk = len(_CJK_PATTERN.findall(text))
+    return math.ceil(cjk * PROMPT_CJK_TOKEN_RATIO.get(provider, 1.0) + (len(text) - cjk) / 4)
+
+
+def _compact_value(value):
+    """數值四捨五入到兩位並去掉多餘的 0，千以上取整數；沒有值時返回 None"""
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        text = str(value).strip()
+        return None if text in _PROMPT_EMPTY_VALUES else text
+    if number != number:
+        return None
+    if abs(number) >= 1000:
+        return f'{number:.0f}'
+    return f'{number:.2f}'.rstrip('0').rstrip('.')
+
+
+def compact_fields(pairs):
+    """[(標籤, 值)] 組成「標籤 值｜…」，略過沒有值的欄位"""
+    fields = []
+    for label, value in pairs:
+        value = _compact_value(value)
+        if value is not None:
+            fields.append(f'{label} {value}')
+    return '｜'.join(fields)
+
+
+def compact_news(news):
+    """新聞只取前幾則，標題過長時截斷"""
+    titles = []
+    for item in (news or [])[:PROMPT_NEWS_ITEMS]:
+        title = (item.get('title') or '').strip()
+        if title:
+            titles.append(title if len(title) <= PROMPT_NEWS_TITLE_CHARS else title[:PROMPT_NEWS_TITLE_CHARS] + '…')
+    return titles
+
+
+def indicator_fields(indicators):
+    return compact_fields([
+        ('RSI14', indicators.get('RSI')),
+        ('MACD', indicators.get('MACD')),
+        ('布林上', indicators.get('BB_UPPER')),
+        ('中', indicators.get('BB_MIDDLE')),
+        ('下', indicators.get('BB_LOWER')),
+        ('K', indicators.get('KD_K')),
+        ('D', indicators.get('KD_D'))
+    ])
+
+
+class PromptBuilder:
+    """
+    組合精簡的結構化提示詞：每個段落一行「標題：內容」（多筆時逐行列出），空段落略過
+    依提供者計算 token 數，超過預算時從優先度最低段落的最後一筆開始捨棄
+    """
+
+    def __init__(self, provider, model=None, budget=None):
+        self.provider = provider
+        self.model = model
+        self.budget = budget or PROMPT_TOKEN_BUDGET
+        self._sections = []
+
+    def section(self, title, lines, priority=0):
+        """lines 可為字串或字串清單；priority 越大越晚被捨棄"""
+        lines = [lines] if isinstance(lines, str) else list(lines)
+        lines = [line for line in lines if line]
+        if lines:
+            self._sections.append({'title': title, 'lines': lines, 'priority': priority,
+                                   'order': len(self._sections)})
+        return self
+
+    @staticmethod
+    def _render(head, sections, tail):
+        parts = [head] if head else []
+        for item in sections:
+            if len(item['lines']) == 1:
+                parts.append(f"{item['title']}：{item['lines'][0]}")
+            else:
+                parts.append(f"{item['title']}：")
+                parts.extend(f"- {line}" for line in item['lines'])
+        if tail:
+            parts.append(tail)
+        return '\n'.join(parts)
+
+    def build(self, head='', tail='', system_prompt=''):
+        """返回 (提示詞, 報告)；報告含 prompt_tokens（含 system）、budget 與捨棄筆數"""
+        sections = [dict(item, lines=list(item['lines'])) for item in self._sections]
+        dropped = 0
+        while True:
+            text = self._render(head, sections, tail)
+            tokens = count_tokens(f"{system_prompt}\n{text}", self.provider, self.model)
+            if tokens <= self.budget or not sections:
+                break
+            lowest = min(sections, key=lambda item: (item['priority'], -item['order']))
+            lowest['lines'].pop()
+            dropped += 1
+            sections = [item for item in sections if item['lines']]
+        return text, {
+            'prompt_tokens': tokens,
+            'budget': self.budget,
+            'dropped_lines': dropped,
+            'over_budget': tokens > self.budget
+        }
+
+
+# ========== AI 文字生成（串流） ==========
+LLM_DEFAULT_MODELS = {
+    'openai': 'gpt-3.5-turbo',
+    'gemini': 'gemini-pro'
+}
+
+
+def llm_default_model(provider):
+    """各提供者預設模型；Ollama 使用設置頁面選定的模型"""
+    if provider == 'ollama':
+        try:
+            return ConfigRepo.get('default_ollama_model', 'llama2')
+        except Exception:
+            return 'llama2'
+    return LLM_DEFAULT_MODELS[provider]
+
+
+def llm_provider_ready(provider):
+    if provider == 'ollama':
+        return OLLAMA_AVAILABLE
+    if provider == 'openai':
+        return OPENAI_AVAILABLE and bool(OPENAI_API_KEY)
+    if provider == 'gemini':
+        return GEMINI_AVAILABLE and bool(GEMINI_API_KEY)
+    return False
+
+
+class LlmMetrics:
+    """各提供者的請求數、失敗數、首個 token 時間（TTFT）、總耗時與提示詞 token 數"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._providers = {}
+
+    def record(self, provider, ttft, total, failed, prompt_tokens=0):
+        with self._lock:
+            item = self._providers.setdefault(provider, {
+                'requests': 0, 'failures': 0, 'ttft_total': 0.0, 'ttft_count': 0,
+                'duration_total': 0.0, 'last_ttft_ms': None, 'prompt_tokens': 0
+            })
+            item['requests'] += 1
+            item['prompt_tokens'] += prompt_tokens
+            item['failures'] += int(failed)
+            item['duration_total'] += total
+            if ttft is not None:
+                item['ttft_total'] += ttft
+                item['ttft_count'] += 1
+                item['last_ttft_ms'] = round(ttft * 1000, 1)
+
+    def stats(self):
+        with self._lock:
+            return {
+                provider: {
+                    'requests': item['requests'],
+                    'failures': item['failures'],
+                    'avg_ttft_ms': round(item['ttft_total'] / item['ttft_count'] * 1000, 1) if item['ttft_count'] else None,
+                    'last_ttft_ms': item['last_ttft_ms'],
+                    'avg_duration_ms': round(item['duration_total'] / item['requests'] * 1000, 1),
+                    'avg_prompt_tokens': round(item['prompt_tokens'] / item['requests'], 1)
+                }
+                for provider, item in self._providers.items()
+            }
+
+
+llm_metrics = LlmMetrics()
+
+
+def _provider_stream(provider, model, system_prompt, prompt, max_tokens=None, temperature=None, usage=None):
+    """向提供者發出串流請求，逐段產生文字；usage 若為 dict，Ollama 結束時填入各階段耗時"""
+    if provider == 'ollama':
+        options = {}
+        if max_tokens:
+            options['num_predict'] = max_tokens
+        if temperature is not None:
+            options['temperature'] = temperature
+        chunks = provider_registry.ollama().chat(
+            model=model,
+            messages=[
+                {'role': 'system', 'content': system_prompt},
+                {'role': 'user', 'content': prompt}
+            ],
+            stream=True,
+            options=options or None,
+            keep_alive=_keep_alive_value(OLLAMA_KEEP_ALIVE)
+        )
+        for chunk in chunks:
+            text = chunk.get('message', {}).get('content')
+            if text:
+                yield text
+            if chunk.get('done') and usage is not None:
+                usage.update(_ollama_usage(chunk))
+
+    elif provider == 'openai':
+        params = {}
+        if max_tokens:
+            params['max_tokens'] = max_tokens
+        if temperature is not None:
+            params['temperature'] = temperature
+        chunks = provider_registry.openai().chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": prompt}
+            ],
+            stream=True,
+            **params
+        )
+        for chunk in chunks:
+            text = chunk.choices[0].delta.content if chunk.choices else None
+            if text:
+                yield text
+
+    elif provider == 'gemini':
+        config = {}
+        if max_tokens:
+            config['max_output_tokens'] = max_tokens
+        if temperature is not None:
+            config['temperature'] = temperature
+        # gemini-pro 沒有 system 角色，與使用者訊息合併
+        chunks = provider_registry.gemini_model(model).generate_content(
+            f"{system_prompt}\n\n{prompt}",
+            generation_config=config or None,
+            stream=True
+        )
+        for chunk in chunks:
+            if chunk.text:
+                yield chunk.text
+
+    else:
+        raise ValueError(f'不支援的提供者：{provider}')
+
+
+def stream_completion(provider, system_prompt, prompt, model=None, timing=None, **options):
+    """
+    串流產生 AI 回覆的文字片段，並記錄 TTFT 與總耗時到 llm_metrics 與 provider_registry
+    timing 若為 dict，結束時填入 ttft_ms / total_ms / model / prompt_tokens（估算），
+    Ollama 另有 usage（載入與生成耗時、實際 token 數）
+    """
+    model = model or llm_default_model(provider)
+    prompt_tokens = count_tokens(f"{system_prompt}\n{prompt}", provider, model)
+    started = time.perf_counter()
+    first = None
+    error = None
+    usage = {}
+    try:
+        for text in _provider_stream(provider, model, system_prompt, prompt, usage=usage, **options):
+            if first is None:
+                first = time.perf_counter()
+            yield text
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        total = time.perf_counter() - started
+        ttft = first - started if first is not None else None
+        llm_metrics.record(provider, ttft, total, error is not None, prompt_tokens)
+        provider_registry.record(provider, ttft, error is not None, error)
+        if usage and provider == 'ollama':
+            ollama_warmer.record(model, usage)
+        if timing is not None:
+            timing.update({
+                'model': model,
+                'prompt_tokens': prompt_tokens,
+                'ttft_ms': round(ttft * 1000, 1) if ttft is not None else None,
+                'total_ms': round(total * 1000, 1)
+            })
+            if usage:
+                timing['usage'] = usage
+
+
+def complete(provider, system_prompt, prompt, model=None, timing=None, **options):
+    """非串流呼叫：收齊全部片段後返回完整文字"""
+    return ''.join(stream_completion(provider, system_prompt, prompt, model, timing, **options))
+
+
+# ========== Ollama 模型常駐 ==========
+# 傳給 Ollama 的 keep_alive：模型閒置多久後卸載（例如 30m、-1 表示常駐）
+OLLAMA_KEEP_ALIVE = os.environ.get('OLLAMA_KEEP_ALIVE', '30m').strip()
+# 啟動時與變更預設模型後預先載入，避免第一次分析等待模型載入
+OLLAMA_PRELOAD = os.environ.get('OLLAMA_PRELOAD', '1').strip().lower() not in ('0', 'false', 'no')
+# load_duration 超過此秒數視為冷啟動（模型原本不在記憶體）
+OLLAMA_COLD_LOAD_THRESHOLD = 0.5
+
+
+def _keep_alive_value(text):
+    """純數字視為秒數，其餘（如 30m）原樣交給 Ollama 解析"""
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+def _ollama_usage(response):
+    """Ollama 最後一段回應帶有各階段耗時（奈秒）與 token 數"""
+    def ms(name):
+        return round((response.get(name) or 0) / 1e6, 1)
+    return {
+        'load_ms': ms('load_duration'),
+        'prompt_eval_ms': ms('prompt_eval_duration'),
+        'eval_ms': ms('eval_duration'),
+        'prompt_tokens': response.get('prompt_eval_count') or 0,
+        'eval_tokens': response.get('eval_count') or 0
+    }
+
+
+class OllamaWarmer:
+    """
+    管理預設 Ollama 模型的 keep_alive 與背景預載，並統計載入時間與生成時間
+    用以區分回覆延遲有多少來自冷啟動載入模型
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ollama-warm')
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._models = {}
+        self.last_preload = None
+
+    def _item(self, model):
+        return self._models.setdefault(model, {
+            'requests': 0, 'cold_loads': 0, 'load_total': 0.0,
+            'prompt_eval_total': 0.0, 'eval_total': 0.0, 'eval_tokens': 0
+        })
+
+    def record(self, model, usage):
+        with self._lock:
+            item = self._item(model)
+            item['requests'] += 1
+            item['cold_loads'] += int(usage['load_ms'] >= OLLAMA_COLD_LOAD_THRESHOLD * 1000)
+            item['load_total'] += usage['load_ms']
+            item['prompt_eval_total'] += usage['prompt_eval_ms']
+            item['eval_total'] += usage['eval_ms']
+            item['eval_tokens'] += usage['eval_tokens']
+
+    def preload(self, model, unload=None):
+        """背景載入 model 並套用 keep_alive；unload 為要釋放記憶體的舊模型"""
+        with self._lock:
+            if model in self._pending:
+                return False
+            self._pending.add(model)
+        self._executor.submit(self._preload, model, unload)
+        return True
+
+    def _preload(self, model, unload):
+        started = time.perf_counter()
+        client = provider_registry.ollama()
+        try:
+            if unload and unload != model:
+                client.generate(model=unload, keep_alive=0)
+            # 空白提示詞只載入模型，不生成內容
+            response = client.generate(model=model, keep_alive=_keep_alive_value(OLLAMA_KEEP_ALIVE))
+            result = {'model': model, 'status': 'ok', 'load_ms': _ollama_usage(response)['load_ms']}
+        except Exception as e:
+            print(f"預載 Ollama 模型 {model} 失敗: {e}")
+            result = {'model': model, 'status': 'error', 'error': str(e)}
+        result.update({'ms': round((time.perf_counter() - started) * 1000, 1), 'at': time.time()})
+        with self._lock:
+            self._pending.discard(model)
+            self.last_preload = result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'keep_alive': OLLAMA_KEEP_ALIVE,
+                'preload': OLLAMA_PRELOAD,
+                'preloading': sorted(self._pending),
+                'last_preload': dict(self.last_preload) if self.last_preload else None,
+                'models': {
+                    model: {
+                        'requests': item['requests'],
+                        'cold_loads': item['cold_loads'],
+                        'avg_load_ms': round(item['load_total'] / item['requests'], 1),
+                        'avg_prompt_eval_ms': round(item['prompt_eval_total'] / item['requests'], 1),
+                        'avg_eval_ms': round(item['eval_total'] / item['requests'], 1),
+                        'tokens_per_s': round(item['eval_tokens'] / item['eval_total'] * 1000, 1)
+                        if item['eval_total'] else None
+                    }
+                    for model, item in self._models.items()
+                }
+            }
+
+
+ollama_warmer = OllamaWarmer()
+
+if OLLAMA_AVAILABLE and OLLAMA_PRELOAD:
+    ollama_warmer.preload(llm_default_model('ollama'))
+
+
+# ========== AI 回覆快取 ==========
+LLM_CACHE_TTL = float(os.environ.get('LLM_CACHE_TTL', '21600'))
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get('LLM_CACHE_MAX_ENTRIES', '2000'))
+LLM_CACHE_PRUNE_INTERVAL = 300
+
+
+class LlmCacheStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.last_prune = 0.0
+
+    def count(self, field):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def prune_due(self):
+        """距上次清理超過間隔時返回 True 並記錄本次時間"""
+        with self._lock:
+            if time.time() - self.last_prune < LLM_CACHE_PRUNE_INTERVAL:
+                return False
+            self.last_prune = time.time()
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'stores': self.stores}
+
+
+llm_cache_stats = LlmCacheStats()
+
+
+def _normalize_prompt(text):
+    # 空白差異不影響快取
+    return ' '.join(text.split())
+
+
+def llm_cache_key(provider, model, system_prompt, prompt, data_date, options):
+    """返回 (cache_key, prompt_hash)"""
+    prompt_hash = hashlib.sha256(
+        f"{_normalize_prompt(system_prompt)}\n{_normalize_prompt(prompt)}".encode('utf-8')
+    ).hexdigest()
+    option_text = json.dumps(options, sort_keys=True)
+    cache_key = hashlib.sha256(
+        f"{provider}|{model}|{prompt_hash}|{data_date}|{option_text}".encode('utf-8')
+    ).hexdigest()
+    return cache_key, prompt_hash
+
+
+def cached_stream_completion(provider, system_prompt, prompt, data_date='', model=None,
+                             timing=None, use_cache=True, **options):
+    """
+    先查 AI 回覆快取，鍵為 (提供者, 模型, 正規化提示詞雜湊, 資料日期)
+    命中時一次產生完整回覆；未命中時串流並在完整收到後寫入快取
+    timing 若為 dict 會填入 cached 與耗時
+    """
+    timing = timing if timing is not None else {}
+    model = model or llm_default_model(provider)
+    cache_key, prompt_hash = llm_cache_key(provider, model, system_prompt, prompt, data_date, options)
+
+    cached = None
+    if use_cache:
+        try:
+            cached = LlmCacheRepo.lookup(cache_key, LLM_CACHE_TTL)
+        except Exception as e:
+            print(f"讀取 AI 回覆快取失敗: {e}")
+    if cached is not None:
+        llm_cache_stats.count('hits')
+        timing.update({'cached': True, 'model': model, 'ttft_ms': 0.0, 'total_ms': 0.0})
+        yield cached
+        return
+
+    llm_cache_stats.count('misses')
+    timing['cached'] = False
+    parts = []
+    for text in stream_completion(provider, system_prompt, prompt, model, timing, **options):
+        parts.append(text)
+        yield text
+
+    response = ''.join(parts)
+    if not use_cache or not response:
+        return
     try:
-        data = request.json or {}
-        user_id = (data.get('user_id') or '').strip()
-        stock_code = (data.get('stock_code') or '').strip()
-        if not user_id or not stock_code:
-            return jsonify({'success': False, 'message': 'user_id 與 stock_code 不能為空'})
+        LlmCacheRepo.store(cache_key, provider, model, prompt_hash, data_date, response)
+        llm_cache_stats.count('stores')
+        if llm_cache_stats.prune_due():
+            LlmCacheRepo.prune(LLM_CACHE_TTL, LLM_CACHE_MAX_ENTRIES)
+    except Exception as e:
+        print(f"寫入 AI 回覆快取失敗: {e}")
 
-        # 查股票名稱
-        stock_info = get_stock_info(stock_code)
-        stock_name = stock_info.get('stock_name', '') if stock_info.get('success') else ''
 
-        with closing(get_conn()) as conn:
-            with closing(conn.cursor(row_factory=dict_row) if DB_IS_PG else conn.cursor()) as cursor:
-                # 檢查是否已存在同一 user 的同一股票
-                cursor.execute(q('SELECT id FROM favorites WHERE user_id = ? AND stock_code = ?'), (user_id, stock_code))
-                if cursor.fetchone():
-                    # 更新時間為最新
-                    cursor.execute(q('UPDATE favorites SET liked_time = CURRENT_TIMESTAMP, stock_name = ? WHERE user_id = ? AND stock_code = ?'), (stock_name, user_id, stock_code))
-                else:
-                    cursor.execute(q('INSERT INTO favorites (user_id, stock_code, stock_name) VALUES (?, ?, ?)'), (user_id, stock_code, stock_name))
-                conn.commit()
-        return jsonify({'success': True})
-    except Exception as e:
-        return jsonify({'success': False, 'message': str(e)})
+def fallback_stream_completion(providers, system_prompt, prompt, timing=None, **kwargs):
+    """
+    依序嘗試 providers（通常來自 provider_registry.select()），經 AI 回覆快取產生片段
+    尚未產生任何片段就失敗時改用下一個提供者；已開始輸出後的錯誤直接拋出
+    timing 會填入實際使用的 provider 與各次失敗 fallbacks
+    """
+    timing = timing if timing is not None else {}
+    timing['fallbacks'] = []
+    if not providers:
+        raise ValueError('無可用的 AI 服務')
+    for index, provider in enumerate(providers):
+        timing['provider'] = provider
+        produced = False
+        try:
+            for text in cached_stream_completion(provider, system_prompt, prompt, timing=timing, **kwargs):
+                produced = True
+                yield text
+            return
+        except Exception as e:
+            if produced or index == len(providers) - 1:
+                raise
+            print(f"{provider} 請求失敗，改用下一個提供者: {e}")
+            timing['fallbacks'].append({'provider': provider, 'error': str(e)})
 
 
-@app.route('/api/favorites/last', methods=['GET'])
-def get_last_favorite():
-    try:
-        user_id = request.args.get('user_id', '').strip()
-        if not user_id:
-            return jsonify({'success': False, 'message': '需要 user_id'})
-        with closing(get_conn()) as conn:
-            if not DB_IS_PG:
-                conn.row_factory = sqlite3.Row
-            with closing(conn.cursor(row_factory=dict_row) if DB_IS_PG else conn.cursor()) as cursor:
-                cursor.execute(q('SELECT * FROM favorites WHERE user_id = ? ORDER BY liked_time DESC LIMIT 1'), (user_id,))
-                row = cursor.fetchone()
-                data = row if DB_IS_PG else (dict(row) if row else None)
-        return jsonify({'success': True, 'data': data})
-    except Exception as e:
-        return jsonify({'success': False, 'message': str(e)})
+CHAT_MAX_TOKENS = 1000
+CHAT_SYSTEM_PROMPT = ('你是專業的台灣股市分析助手，可分析技術指標（RSI、MACD、KD、布林通道）、解讀 K 線形態、'
+                      '分析市場趨勢、解釋財經名詞並提供投資建議（須提醒風險）。請用繁體中文回答，語氣專業但友善。')
+CHAT_TEMPERATURE = 0.7
 
 
-@app.route('/api/favorites/<int:fav_id>', methods=['DELETE'])
-def delete_favorite(fav_id: int):
-    try:
-        user_id = request.args.get('user_id', '').strip()
-        with closing(get_conn()) as conn:
-            with closing(conn.cursor(row_factory=dict_row) if DB_IS_PG else conn.cursor()) as cursor:
-                if user_id:
-                    cursor.execute(q('DELETE FROM favorites WHERE id = ? AND user_id = ?'), (fav_id, user_id))
-                else:
-                    cursor.execute(q('DELETE FROM favorites WHERE id = ?'), (fav_id,))
-                conn.commit()
-        return jsonify({'success': True})
-    except Exception as e:
-        return jsonify({'success': False, 'message': str(e)})
+def _chat_stream_response(providers, system_prompt, message, options, cache_args, prompt_report=None):
+    """AI 回覆以 NDJSON 串流：每個片段一行，結束行附實際提供者、完整回覆、是否命中快取與耗時"""
+    def line(payload):
+        return json.dumps(payload, ensure_ascii=False) + '\n'
 
+    def generate():
+        timing = {}
+        parts = []
+        try:
+            for text in fallback_stream_completion(providers, system_prompt, message, timing=timing,
+                                                   **cache_args, **options):
+                parts.append(text)
+                yield line({'type': 'token', 'text': text})
+        except Exception as e:
+            yield line({'type': 'error', 'message': f'AI 請求失敗: {str(e)}'})
+            return
+        yield line({
+            'type': 'done',
+            'provider': timing.get('provider'),
+            'reply': ''.join(parts),
+            'cached': timing.get('cached', False),
+            'timing': timing,
+            'prompt': prompt_report
+        })
 
-@app.route('/api/favorites/<stock_code>', methods=['DELETE'])
-def delete_favorite_by_code(stock_code: str):
-    try:
-        user_id = request.args.get('user_id', '').strip()
-        if not user_id:
-            return jsonify({'success': False, 'message': '需要 user_id'})
-        
-        with closing(get_conn()) as conn:
-            with closing(conn.cursor(row_factory=dict_row) if DB_IS_PG else conn.cursor()) as cursor:
-                cursor.execute(q('DELETE FROM favorites WHERE user_id = ? AND stock_code = ?'), (user_id, stock_code))
-                conn.commit()
-        return jsonify({'success': True})
-    except Exception as e:
-        return jsonify({'success': False, 'message': str(e)})
+    return Response(generate(), mimetype='application/x-ndjson', headers={'Cache-Control': 'no-cache'})
 
 
 @app.route('/api/ai/chat', methods=['POST'])
 def ai_chat():
     """
-    AI 聊天端點 - 支援 OpenAI 和 Gemini
+    AI 聊天端點 - 支援 Ollama、OpenAI 和 Gemini；provider 為 auto 時依延遲選擇並自動備援
+    {"stream": true} 時以 NDJSON 逐段回傳 {"type": "token"}，最後為 {"type": "done"} 或 {"type": "error"}
     """
     try:
         data = request.json or {}
@@ -1061,79 +3540,53 @@ def ai_chat():
         if not message:
             return jsonify({'success': False, 'message': '訊息不能為空'})
         
-        # 構建系統提示詞
-        system_prompt = """你是一個專業的台灣股市分析助手。你可以：
-1. 分析股票技術指標（RSI、MACD、KD、布林通道等）
-2. 解讀 K 線圖形態
-3. 提供投資建議（但要提醒風險）
-4. 解釋財經名詞
-5. 分析市場趨勢
-
-請用繁體中文回答，語氣專業但友善。"""
-        
-        # 如果有股票上下文，添加到訊息中
+        system_prompt = CHAT_SYSTEM_PROMPT
+        available = provider_registry.select()
+        providers = available if provider == 'auto' else [provider]
+
+        # 如果有股票上下文，以精簡格式加在問題前；超過 token 預算時先捨棄技術指標
+        builder = PromptBuilder(providers[0] if providers else provider)
         if stock_context:
-            context_info = f"\n\n當前查詢的股票資訊：\n"
-            context_info += f"代碼: {stock_context.get('stock_code', 'N/A')}\n"
-            context_info += f"名稱: {stock_context.get('stock_name', 'N/A')}\n"
-            context_info += f"現價: {stock_context.get('current_price', 'N/A')}\n"
-            
-            if stock_context.get('technical_indicators'):
-                ti = stock_context['technical_indicators']
-                context_info += f"\n技術指標：\n"
-                context_info += f"RSI: {ti.get('RSI', 'N/A')}\n"
-                context_info += f"MACD: {ti.get('MACD', 'N/A')}\n"
-                context_info += f"KD K值: {ti.get('KD_K', 'N/A')}\n"
-                context_info += f"KD D值: {ti.get('KD_D', 'N/A')}\n"
-            
-            message = context_info + "\n\n使用者問題：" + message
-        
-        # 根據提供者調用不同的 API
-        if provider == 'openai' and OPENAI_AVAILABLE and OPENAI_API_KEY:
-            response = openai.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": message}
-                ],
-                max_tokens=1000,
-                temperature=0.7
-            )
-            reply = response.choices[0].message.content
-            return jsonify({
-                'success': True,
-                'reply': reply,
-                'provider': 'openai'
-            })
-        
-        elif provider == 'gemini' and GEMINI_AVAILABLE and GEMINI_API_KEY:
-            model = genai.GenerativeModel('gemini-pro')
-            full_prompt = f"{system_prompt}\n\n{message}"
-            response = model.generate_content(full_prompt)
-            reply = response.text
-            return jsonify({
-                'success': True,
-                'reply': reply,
-                'provider': 'gemini'
-            })
+            stock = ' '.join(str(stock_context[key]) for key in ('stock_code', 'stock_name') if stock_context.get(key))
+            price = compact_fields([('現價', stock_context.get('current_price'))])
+            builder.section('股票', '｜'.join(part for part in (stock, price) if part), priority=1)
+            builder.section('技術', indicator_fields(stock_context.get('technical_indicators') or {}))
+        message, prompt_report = builder.build(tail=f'問題：{message}', system_prompt=system_prompt)
         
-        else:
-            available = []
-            if OPENAI_AVAILABLE and OPENAI_API_KEY:
-                available.append('openai')
-            if GEMINI_AVAILABLE and GEMINI_API_KEY:
-                available.append('gemini')
-            
+        if not llm_provider_ready(providers[0] if providers else None):
             if not available:
                 return jsonify({
                     'success': False,
-                    'message': 'AI 服務未配置。請設置 OPENAI_API_KEY 或 GEMINI_API_KEY 環境變數'
+                    'message': 'AI 服務未配置。請安裝 Ollama 或設置 OPENAI_API_KEY / GEMINI_API_KEY 環境變數'
                 })
             else:
                 return jsonify({
                     'success': False,
                     'message': f'不支援的提供者：{provider}。可用: {", ".join(available)}'
                 })
+
+        options = {'max_tokens': CHAT_MAX_TOKENS, 'temperature': CHAT_TEMPERATURE}
+        # 快取鍵帶上股票最新 K 線日期；{"no_cache": true} 時強制重新生成
+        kline = stock_context.get('kline_data') if stock_context else None
+        cache_args = {
+            'data_date': str(kline[-1][0]) if kline and isinstance(kline[-1], list) else '',
+            'use_cache': not data.get('no_cache')
+        }
+        if data.get('stream') or _arg_flag(request.args, 'stream'):
+            return _chat_stream_response(providers, system_prompt, message, options, cache_args, prompt_report)
+
+        timing = {}
+        reply = ''.join(fallback_stream_completion(
+            providers, system_prompt, message, timing=timing, **cache_args, **options
+        ))
+        return jsonify({
+            'success': True,
+            'reply': reply,
+            'provider': timing['provider'],
+            'cached': timing['cached'],
+            'timing': timing,
+            'prompt': prompt_report
+        })
     
     except Exception as e:
         return jsonify({
@@ -1145,29 +3598,21 @@ def ai_chat():
 @app.route('/api/ai/providers', methods=['GET'])
 def get_ai_providers():
     """
-    獲取可用的 AI 提供者
+    獲取可用的 AI 提供者，依量測延遲排序；多於一個時最前面加上自動選擇
     """
-    providers = []
-    
-    # Ollama 優先
-    if OLLAMA_AVAILABLE:
-        providers.append({
-            'id': 'ollama',
-            'name': 'Ollama (本地)',
-            'available': True
-        })
-    
-    if OPENAI_AVAILABLE and OPENAI_API_KEY:
-        providers.append({
-            'id': 'openai',
-            'name': 'OpenAI GPT',
-            'available': True
-        })
-    
-    if GEMINI_AVAILABLE and GEMINI_API_KEY:
-        providers.append({
-            'id': 'gemini',
-            'name': 'Google Gemini',
+    health = provider_registry.stats()
+    providers = [{
+        'id': provider,
+        'name': PROVIDER_NAMES[provider],
+        'available': True,
+        'healthy': health[provider]['healthy'],
+        'latency_ms': health[provider]['latency_ms']
+    } for provider in provider_registry.select()]
+
+    if len(providers) > 1:
+        providers.insert(0, {
+            'id': 'auto',
+            'name': '自動（依延遲選擇）',
             'available': True
         })
     
@@ -1253,166 +3698,589 @@ def get_financial_data(stock_code):
         return {}
 
 
+# ========== 股票分析工作 ==========
+class AnalysisError(Exception):
+    """分析無法進行（例如查無股價或歷史數據），訊息直接回給使用者"""
+
+
+ANALYSIS_STAGES = {
+    'queued': '排隊中',
+    'sources': '取得股價、財務數據與新聞',
+    'llm': 'AI 生成分析',
+    'done': '完成',
+    'failed': '失敗'
+}
+
+
+# 各資料來源同時抓取，個別逾時（秒）；逾時或失敗的來源以預設值代替
+ANALYSIS_SOURCE_TIMEOUTS = {
+    'market_data': float(os.environ.get('ANALYSIS_MARKET_TIMEOUT', '30')),
+    'fundamentals': float(os.environ.get('ANALYSIS_FUNDAMENTALS_TIMEOUT', '12')),
+    'news': float(os.environ.get('ANALYSIS_NEWS_TIMEOUT', '12'))
+}
+
+_analysis_source_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('ANALYSIS_SOURCE_WORKERS', '8')),
+    thread_name_prefix='analysis-source'
+)
+
+
+def _elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 1)
+
+
+def _fetch_sources(sources):
+    """
+    sources: {名稱: (函式, 預設值)}，全部同時執行
+    返回 ({名稱: 結果}, {名稱: {'status', 'ms'}})；status 為 ok / timeout / error
+    """
+    started = time.perf_counter()
+    durations = {}
+
+    def timed(name, func):
+        begin = time.perf_counter()
+        try:
+            return func()
+        finally:
+            durations[name] = _elapsed_ms(begin)
+
+    futures = {
+        name: _analysis_source_executor.submit(timed, name, func)
+        for name, (func, _) in sources.items()
+    }
+    results, timings = {}, {}
+    for name, future in futures.items():
+        remaining = ANALYSIS_SOURCE_TIMEOUTS.get(name, 30) - (time.perf_counter() - started)
+        try:
+            results[name] = future.result(timeout=max(remaining, 0))
+            timings[name] = {'status': 'ok', 'ms': durations.get(name)}
+        except FutureTimeoutError:
+            results[name] = sources[name][1]
+            timings[name] = {'status': 'timeout', 'ms': _elapsed_ms(started)}
+        except Exception as e:
+            print(f"分析資料來源 {name} 失敗: {e}")
+            results[name] = sources[name][1]
+            timings[name] = {'status': 'error', 'ms': durations.get(name)}
+    return results, timings
+
+
+ANALYSIS_SYSTEM_PROMPT = '你是一個專業的台灣股市分析師，擅長技術分析和基本面分析。'
+ANALYSIS_INSTRUCTIONS = ('請依數據回答：1.股價在年度區間的位置 2.技術指標的買賣訊號 3.今日高低點預測 '
+                         '4.操作建議（強烈買入/買入/持有/賣出/強烈賣出）5.建議買入價與賣出價。繁體中文，簡潔明確。')
+ANALYSIS_LLM_ERRORS = {
+    'ollama': "Ollama 分析失敗，請在設置頁面下載模型\n錯誤: {error}",
+    'openai': "OpenAI 分析失敗: {error}",
+    'gemini': "Gemini 分析失敗: {error}"
+}
+
+
+def run_stock_analysis(stock_code, progress=None, on_token=None):
+    """
+    自動分析股票：整合歷史數據、技術指標、財務報表、新聞
+    由 provider_registry 依延遲選擇 AI 生成買賣建議；progress(stage) 於各階段開始時呼叫，
+    on_token(text) 於 AI 回覆逐段產生時呼叫
+    返回分析結果 dict（含各階段耗時 timings），無法分析時拋出 AnalysisError
+    """
+    report = progress or (lambda stage: None)
+    started = time.perf_counter()
+
+    # 1. 同時獲取股價與一年歷史數據、財務數據和新聞
+    report('sources')
+    sources, timings = _fetch_sources({
+        'market_data': (lambda: get_stock_info(stock_code, history=True, years=1), {}),
+        'fundamentals': (lambda: get_financial_data(stock_code), {}),
+        'news': (lambda: get_stock_news(stock_code), [])
+    })
+    timings['sources_ms'] = _elapsed_ms(started)
+    stock_info = sources['market_data']
+    financial_data = sources['fundamentals']
+    news = sources['news']
+    if not stock_info.get('success'):
+        raise AnalysisError('無法獲取股票數據')
+
+    # 2. 計算一年內最高最低價
+    kline_data = stock_info.get('kline_data', [])
+    if not kline_data:
+        raise AnalysisError('無歷史數據')
+
+    # 取最近252個交易日（約一年）
+    year_data = kline_data[-252:] if len(kline_data) > 252 else kline_data
+
+    # K 線格式: [日期, 開盤, 收盤, 最低, 最高, 成交量]
+    highs = [float(d[4]) for d in year_data]
+    lows = [float(d[3]) for d in year_data]
+    closes = [float(d[2]) for d in year_data]
+
+    year_high = max(highs)
+    year_low = min(lows)
+    current_price = closes[-1]
+
+    # 計算今日預測（使用技術指標）
+    indicators = stock_info.get('technical_indicators', {})
+
+    # 3. 構建精簡的分析提示詞，token 數依第一個候選提供者計算
+    stock_name = stock_info.get('stock_name') or stock_code
+    providers = provider_registry.select()
+    builder = PromptBuilder(providers[0] if providers else 'ollama')
+    builder.section('價格', compact_fields([
+        ('現價', current_price),
+        ('一年高', year_high),
+        ('一年低', year_low),
+        ('區間位置%', (current_price - year_low) / (year_high - year_low) * 100)
+    ]), priority=3)
+    builder.section('技術', indicator_fields(indicators), priority=2)
+    builder.section('財務', compact_fields([
+        ('本益比', financial_data.get('pe_ratio')),
+        ('EPS', financial_data.get('eps')),
+        ('ROE', financial_data.get('roe')),
+        ('殖利率', financial_data.get('dividend_yield'))
+    ]), priority=1)
+    builder.section('新聞', compact_news(news))
+    analysis_prompt, prompt_report = builder.build(
+        head=f'台股 {stock_code} {stock_name}',
+        tail=ANALYSIS_INSTRUCTIONS,
+        system_prompt=ANALYSIS_SYSTEM_PROMPT
+    )
+
+    # 4. 使用 AI 生成分析（依量測延遲選擇，失敗時改用下一個），片段產生時交給 on_token
+    report('llm')
+    llm_started = time.perf_counter()
+    llm_timing = {'provider': providers[0] if providers else None}
+
+    if not providers:
+        ai_response = "無可用的 AI 服務。請安裝 Ollama 或配置 OpenAI/Gemini API。"
+    else:
+        parts = []
+        try:
+            for text in fallback_stream_completion(providers, ANALYSIS_SYSTEM_PROMPT, analysis_prompt,
+                                                   data_date=year_data[-1][0], timing=llm_timing):
+                parts.append(text)
+                if on_token:
+                    on_token(text)
+            ai_response = ''.join(parts)
+        except Exception as e:
+            provider = llm_timing['provider']
+            print(f"{provider} 分析失敗: {e}")
+            ai_response = ANALYSIS_LLM_ERRORS[provider].format(error=str(e))
+
+    timings['llm_ms'] = _elapsed_ms(llm_started)
+    timings['llm'] = llm_timing
+    timings['prompt'] = prompt_report
+    timings['total_ms'] = _elapsed_ms(started)
+
+    # 5. 返回分析結果
+    return {
+        'stock_code': stock_code,
+        'stock_name': stock_name,
+        'current_price': current_price,
+        'year_high': year_high,
+        'year_low': year_low,
+        'price_position': round((current_price - year_low) / (year_high - year_low) * 100, 1),
+        'technical_indicators': indicators,
+        'financial_data': financial_data,
+        'news': news[:3],
+        'ai_recommendation': ai_response,
+        'ai_cached': llm_timing.get('cached', False),
+        'timings': timings
+    }
+
+
+ANALYSIS_WORKERS = int(os.environ.get('ANALYSIS_WORKERS', '2'))
+# 同一檔股票在這段時間內完成的分析直接沿用
+ANALYSIS_FRESHNESS = float(os.environ.get('ANALYSIS_FRESHNESS', '300'))
+ANALYSIS_JOB_RETENTION = float(os.environ.get('ANALYSIS_JOB_RETENTION', '3600'))
+ANALYSIS_SSE_HEARTBEAT = 15
+
+
+class AnalysisJob:
+    """單一分析工作的狀態；狀態改變時以 Condition 通知等待者（輪詢與 SSE）"""
+
+    def __init__(self, stock_code):
+        self.id = uuid.uuid4().hex
+        self.stock_code = stock_code
+        self.status = 'queued'
+        self.stage = 'queued'
+        self.stages = [{'stage': 'queued', 'at': time.time()}]
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.version = 0
+        self.stage_version = 0
+        self.tokens = []
+        self._cond = threading.Condition()
+
+    def _change(self, **fields):
+        with self._cond:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            if 'stage' in fields:
+                self.stages.append({'stage': fields['stage'], 'at': time.time()})
+            self.version += 1
+            self.stage_version += 1
+            self._cond.notify_all()
+
+    def add_token(self, text):
+        """AI 回覆產生的片段"""
+        with self._cond:
+            self.tokens.append(text)
+            self.version += 1
+            self._cond.notify_all()
+
+    def tokens_since(self, index):
+        """返回 (index 之後的片段合併文字, 新的 index)"""
+        with self._cond:
+            return ''.join(self.tokens[index:]), len(self.tokens)
+
+    def set_stage(self, stage):
+        self._change(status='running', stage=stage)
+
+    def finish(self, result):
+        self._change(status='done', stage='done', result=result, finished_at=time.time())
+
+    def fail(self, message):
+        self._change(status='failed', stage='failed', error=message, finished_at=time.time())
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed')
+
+    def wait(self, version, timeout):
+        """等到狀態比 version 新、工作結束或逾時，返回目前 version"""
+        with self._cond:
+            self._cond.wait_for(lambda: self.version != version or self.finished, timeout)
+            return self.version
+
+    def snapshot(self, partial=True):
+        """partial=True 時附上進行中的 AI 回覆（partial_text）"""
+        with self._cond:
+            data = {
+                'id': self.id,
+                'stock_code': self.stock_code,
+                'status': self.status,
+                'stage': self.stage,
+                'stage_label': ANALYSIS_STAGES.get(self.stage, self.stage),
+                'stages': [dict(item) for item in self.stages],
+                'created_at': self.created_at,
+                'finished_at': self.finished_at,
+                'result': self.result,
+                'error': self.error
+            }
+            if partial and not self.finished:
+                data['partial_text'] = ''.join(self.tokens)
+            return data
+
+
+class AnalysisJobManager:
+    """
+    分析工作管理：由固定數量的 worker 執行，同一檔股票進行中或仍新鮮的工作直接沿用
+    完成超過保留時間的工作會被清除
+    """
+
+    def __init__(self, workers):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='analysis')
+        self._jobs = OrderedDict()
+        self._latest = {}
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.reused = 0
+
+    def submit(self, stock_code):
+        """返回 (job, 是否沿用既有工作)"""
+        with self._lock:
+            self._prune()
+            job = self._jobs.get(self._latest.get(stock_code))
+            if job and (not job.finished or (
+                    job.status == 'done' and time.time() - job.finished_at < ANALYSIS_FRESHNESS)):
+                self.reused += 1
+                return job, True
+            job = AnalysisJob(stock_code)
+            self._jobs[job.id] = job
+            self._latest[stock_code] = job.id
+            self.submitted += 1
+        self._executor.submit(self._run, job)
+        return job, False
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job):
+        try:
+            job.finish(run_stock_analysis(job.stock_code, job.set_stage, job.add_token))
+        except AnalysisError as e:
+            job.fail(str(e))
+        except Exception as e:
+            job.fail(f'分析失敗: {str(e)}')
+
+    def _prune(self):
+        cutoff = time.time() - ANALYSIS_JOB_RETENTION
+        for job_id, job in list(self._jobs.items()):
+            if job.finished and job.finished_at < cutoff:
+                del self._jobs[job_id]
+                if self._latest.get(job.stock_code) == job_id:
+                    del self._latest[job.stock_code]
+
+    def stats(self):
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+        return {
+            'jobs': len(statuses),
+            'queued': statuses.count('queued'),
+            'running': statuses.count('running'),
+            'submitted': self.submitted,
+            'reused': self.reused
+        }
+
+
+analysis_jobs = AnalysisJobManager(ANALYSIS_WORKERS)
+
+
+@app.route('/api/analyze/stock/<stock_code>', methods=['POST'])
+def create_analysis_job(stock_code):
+    """
+    API 端點：建立分析工作並立即返回工作資訊
+    之後以 GET /api/analyze/jobs/<id> 輪詢，或訂閱 /api/analyze/jobs/<id>/events
+    """
+    job, reused = analysis_jobs.submit(stock_code.strip())
+    return jsonify({'success': True, 'job': job.snapshot(), 'reused': reused})
+
+
+@app.route('/api/analyze/jobs/<job_id>', methods=['GET'])
+def get_analysis_job(job_id):
+    """API 端點：查詢分析工作狀態與結果"""
+    job = analysis_jobs.get(job_id)
+    if not job:
+        return jsonify({'success': False, 'message': '查無此分析工作'})
+    return jsonify({'success': True, 'job': job.snapshot()})
+
+
+@app.route('/api/analyze/jobs/<job_id>/events', methods=['GET'])
+def stream_analysis_job(job_id):
+    """
+    API 端點：以 Server-Sent Events 推送分析進度，完成或失敗後結束
+    事件：stage（階段改變）、token（AI 回覆片段）、done / failed（最終結果）
+    """
+    job = analysis_jobs.get(job_id)
+    if not job:
+        return jsonify({'success': False, 'message': '查無此分析工作'})
+
+    def generate():
+        version = -1
+        stage_seen = None
+        token_index = 0
+        while True:
+            current = job.wait(version, ANALYSIS_SSE_HEARTBEAT)
+            if current == version and not job.finished:
+                yield ': keep-alive\n\n'
+                continue
+            version = current
+            text, token_index = job.tokens_since(token_index)
+            if text:
+                yield f"event: token\ndata: {json.dumps({'text': text}, ensure_ascii=False)}\n\n"
+            if job.stage_version != stage_seen:
+                stage_seen = job.stage_version
+                snapshot = job.snapshot(partial=False)
+                event = snapshot['status'] if snapshot['status'] in ('done', 'failed') else 'stage'
+                yield f"event: {event}\ndata: {json.dumps(snapshot, ensure_ascii=False, default=str)}\n\n"
+                if event != 'stage':
+                    return
+
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
 @app.route('/api/analyze/stock/<stock_code>', methods=['GET'])
 def analyze_stock(stock_code):
     """
-    自動分析股票：整合歷史數據、技術指標、財務報表、新聞
-    使用 Ollama 本地 AI 生成買賣建議
+    自動分析股票（同步版本）：經分析工作執行並等待結果
     """
-    try:
-        # 1. 獲取股票基本信息和一年歷史數據
-        stock_info = get_stock_info(stock_code)
-        if not stock_info.get('success'):
-            return jsonify({
-                'success': False,
-                'message': '無法獲取股票數據'
-            })
-        
-        # 2. 計算一年內最高最低價
-        kline_data = stock_info.get('data', {}).get('kline_data', [])
-        if not kline_data:
-            return jsonify({
-                'success': False,
-                'message': '無歷史數據'
-            })
-        
-        # 取最近252個交易日（約一年）
-        year_data = kline_data[-252:] if len(kline_data) > 252 else kline_data
-        
-        highs = [float(d['high']) for d in year_data]
-        lows = [float(d['low']) for d in year_data]
-        closes = [float(d['close']) for d in year_data]
-        
-        year_high = max(highs)
-        year_low = min(lows)
-        current_price = closes[-1]
-        
-        # 計算今日預測（使用技術指標）
-        indicators = stock_info.get('data', {}).get('technical_indicators', {})
-        
-        # 3. 獲取財務數據和新聞
-        financial_data = get_financial_data(stock_code)
-        news = get_stock_news(stock_code)
-        
-        # 4. 構建分析提示詞
-        stock_name = stock_info.get('data', {}).get('name', stock_code)
-        
-        analysis_prompt = f"""請分析以下台灣股票 {stock_code} ({stock_name}) 的數據並提供買賣建議：
-
-【價格數據】
-- 當前價格：{current_price:.2f} 元
-- 一年最高價：{year_high:.2f} 元
-- 一年最低價：{year_low:.2f} 元
-- 相對位置：{((current_price - year_low) / (year_high - year_low) * 100):.1f}%
-
-【技術指標】
-- RSI(14)：{indicators.get('rsi', {}).get('current', 'N/A')}
-- MACD：{indicators.get('macd', {}).get('macd', 'N/A')}
-- 布林通道：上軌 {indicators.get('bb', {}).get('upper', 'N/A')}，中軌 {indicators.get('bb', {}).get('middle', 'N/A')}，下軌 {indicators.get('bb', {}).get('lower', 'N/A')}
-- KD指標：K值 {indicators.get('kd', {}).get('k', 'N/A')}，D值 {indicators.get('kd', {}).get('d', 'N/A')}
-
-【財務數據】
-- 本益比：{financial_data.get('pe_ratio', 'N/A')}
-- EPS：{financial_data.get('eps', 'N/A')}
-- ROE：{financial_data.get('roe', 'N/A')}
-- 股息殖利率：{financial_data.get('dividend_yield', 'N/A')}
-
-【最新新聞】
-{chr(10).join([f"- {n['title']}" for n in news[:3]]) if news else "暫無新聞"}
-
-請根據以上數據：
-1. 分析當前股價處於年度價格區間的位置
-2. 技術指標顯示的買賣訊號
-3. 預測今日可能的高低點範圍
-4. 給出明確的操作建議（強烈買入/買入/持有/賣出/強烈賣出）
-5. 設定建議的買入價位和賣出價位
-
-請用繁體中文回答，簡潔明確。"""
-
-        # 5. 使用 AI 生成分析（優先使用 Ollama）
-        ai_response = ""
-        
-        if OLLAMA_AVAILABLE:
-            try:
-                # 獲取默認模型
-                default_model = 'llama2'
-                try:
-                    with closing(get_conn()) as conn:
-                        if not DB_IS_PG:
-                            conn.row_factory = sqlite3.Row
-                        with closing(conn.cursor(row_factory=dict_row) if DB_IS_PG else conn.cursor()) as cursor:
-                            cursor.execute(q('SELECT config_value FROM app_config WHERE config_key = ?'), ('default_ollama_model',))
-                            row = cursor.fetchone()
-                            if row:
-                                default_model = row['config_value'] if DB_IS_PG else row['config_value']
-                except:
-                    pass  # 使用默認值
-                
-                client = ollama.Client(host=OLLAMA_HOST)
-                response = client.chat(
-                    model=default_model,
-                    messages=[
-                        {
-                            'role': 'system',
-                            'content': '你是一個專業的台灣股市分析師，擅長技術分析和基本面分析。'
-                        },
-                        {
-                            'role': 'user',
-                            'content': analysis_prompt
-                        }
-                    ]
-                )
-                ai_response = response['message']['content']
-            except Exception as e:
-                print(f"Ollama 分析失敗: {e}")
-                ai_response = f"Ollama 分析失敗，請在設置頁面下載模型\n錯誤: {str(e)}"
-        
-        elif OPENAI_AVAILABLE and OPENAI_API_KEY:
-            try:
-                response = openai.chat.completions.create(
-                    model="gpt-3.5-turbo",
-                    messages=[
-                        {"role": "system", "content": "你是一個專業的台灣股市分析師。"},
-                        {"role": "user", "content": analysis_prompt}
-                    ]
-                )
-                ai_response = response.choices[0].message.content
-            except Exception as e:
-                ai_response = f"OpenAI 分析失敗: {str(e)}"
-        
-        elif GEMINI_AVAILABLE and GEMINI_API_KEY:
-            try:
-                model = genai.GenerativeModel('gemini-pro')
-                response = model.generate_content(analysis_prompt)
-                ai_response = response.text
-            except Exception as e:
-                ai_response = f"Gemini 分析失敗: {str(e)}"
-        
-        else:
-            ai_response = "無可用的 AI 服務。請安裝 Ollama 或配置 OpenAI/Gemini API。"
-        
-        # 6. 返回分析結果
-        return jsonify({
-            'success': True,
-            'analysis': {
-                'stock_code': stock_code,
-                'stock_name': stock_name,
-                'current_price': current_price,
-                'year_high': year_high,
-                'year_low': year_low,
-                'price_position': round((current_price - year_low) / (year_high - year_low) * 100, 1),
-                'technical_indicators': indicators,
-                'financial_data': financial_data,
-                'news': news[:3],
-                'ai_recommendation': ai_response
+    job, _ = analysis_jobs.submit(stock_code.strip())
+    version = -1
+    while not job.finished:
+        version = job.wait(version, None)
+    if job.status == 'failed':
+        return jsonify({'success': False, 'message': job.error})
+    return jsonify({'success': True, 'analysis': job.result})
+
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """
+    API 端點：快取與連線等內部計數，用於容量評估
+    """
+    return jsonify({
+        'success': True,
+        'quote_cache': quote_cache.stats(),
+        'indicator_cache': indicator_cache.stats(),
+        'db_pool': db_pool_stats(),
+        'search_history': search_history_writer.stats(),
+        'config_cache': config_cache.stats(),
+        'admin_flag_cache': admin_flag_cache.stats(),
+        'analysis_jobs': analysis_jobs.stats(),
+        'llm': llm_metrics.stats(),
+        'llm_providers': provider_registry.stats(),
+        'ollama': ollama_warmer.stats(),
+        'ollama_pulls': model_pulls.stats(),
+        'llm_cache': llm_cache_stats.stats()
+    })
+
+
+# ========== Ollama 模型背景下載 ==========
+OLLAMA_PULL_WORKERS = int(os.environ.get('OLLAMA_PULL_WORKERS', '1'))
+# 排隊加下載中的上限，超過時拒絕新的下載
+OLLAMA_PULL_MAX_ACTIVE = int(os.environ.get('OLLAMA_PULL_MAX_ACTIVE', '4'))
+OLLAMA_PULL_RETENTION = float(os.environ.get('OLLAMA_PULL_RETENTION', '3600'))
+OLLAMA_PULL_SSE_HEARTBEAT = 15
+# 進度通知的最小間隔，避免每個資料塊都喚醒等待者
+OLLAMA_PULL_PROGRESS_INTERVAL = 0.5
+
+
+class ModelPull:
+    """單一模型下載的狀態；進度改變時以 Condition 通知等待者（輪詢與 SSE）"""
+
+    def __init__(self, model):
+        self.id = uuid.uuid4().hex
+        self.model = model
+        self.status = 'queued'
+        self.detail = 'queued'
+        self.layers = {}
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.version = 0
+        self._notified_at = 0.0
+        self._cond = threading.Condition()
+
+    def _notify(self):
+        self.version += 1
+        self._notified_at = time.time()
+        self._cond.notify_all()
+
+    def progress(self, chunk):
+        """處理 Ollama 串流下載的一段進度：{'status', 'digest', 'total', 'completed'}"""
+        with self._cond:
+            detail = chunk.get('status') or self.detail
+            digest = chunk.get('digest')
+            if digest and chunk.get('total'):
+                self.layers[digest] = (chunk.get('completed') or 0, chunk['total'])
+            changed = detail != self.detail or self.status != 'running'
+            self.status = 'running'
+            self.detail = detail
+            if changed or time.time() - self._notified_at >= OLLAMA_PULL_PROGRESS_INTERVAL:
+                self._notify()
+
+    def finish(self, error=None):
+        with self._cond:
+            self.status = 'failed' if error else 'done'
+            self.detail = self.status
+            self.error = error
+            self.finished_at = time.time()
+            self._notify()
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed')
+
+    def wait(self, version, timeout):
+        """等到狀態比 version 新、下載結束或逾時，返回目前 version"""
+        with self._cond:
+            self._cond.wait_for(lambda: self.version != version or self.finished, timeout)
+            return self.version
+
+    def snapshot(self):
+        with self._cond:
+            completed = sum(done for done, _ in self.layers.values())
+            total = sum(size for _, size in self.layers.values())
+            return {
+                'id': self.id,
+                'model': self.model,
+                'status': self.status,
+                'detail': self.detail,
+                'completed_bytes': completed,
+                'total_bytes': total,
+                'percent': round(completed / total * 100, 1) if total else None,
+                'created_at': self.created_at,
+                'finished_at': self.finished_at,
+                'error': self.error
             }
-        })
-    
-    except Exception as e:
-        return jsonify({
-            'success': False,
-            'message': f'分析失敗: {str(e)}'
-        })
+
+
+class ModelPullManager:
+    """
+    模型下載管理：由固定數量的 worker 以 Ollama 串流下載執行
+    同一模型進行中的下載直接沿用，排隊加下載中的數量有上限
+    """
+
+    def __init__(self, workers):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ollama-pull')
+        self._pulls = OrderedDict()
+        self._active = {}
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.reused = 0
+        self.rejected = 0
+
+    def submit(self, model):
+        """返回 (pull, 是否沿用既有下載)；進行中的下載過多時返回 (None, False)"""
+        with self._lock:
+            self._prune()
+            pull = self._active.get(model)
+            if pull:
+                self.reused += 1
+                return pull, True
+            if len(self._active) >= OLLAMA_PULL_MAX_ACTIVE:
+                self.rejected += 1
+                return None, False
+            pull = ModelPull(model)
+            self._pulls[pull.id] = pull
+            self._active[model] = pull
+            self.submitted += 1
+        self._executor.submit(self._run, pull)
+        return pull, False
+
+    def get(self, pull_id):
+        with self._lock:
+            return self._pulls.get(pull_id)
+
+    def list(self):
+        with self._lock:
+            pulls = list(self._pulls.values())
+        return [pull.snapshot() for pull in reversed(pulls)]
+
+    def _run(self, pull):
+        error = None
+        try:
+            for chunk in provider_registry.ollama().pull(pull.model, stream=True):
+                pull.progress(chunk)
+        except Exception as e:
+            error = f'下載失敗: {str(e)}'
+        with self._lock:
+            self._active.pop(pull.model, None)
+        pull.finish(error)
+        # 下載的正好是預設模型時順便載入記憶體
+        if not error and OLLAMA_PRELOAD and pull.model == llm_default_model('ollama'):
+            ollama_warmer.preload(pull.model)
+
+    def _prune(self):
+        cutoff = time.time() - OLLAMA_PULL_RETENTION
+        for pull_id, pull in list(self._pulls.items()):
+            if pull.finished and pull.finished_at < cutoff:
+                del self._pulls[pull_id]
+
+    def stats(self):
+        with self._lock:
+            statuses = [pull.status for pull in self._pulls.values()]
+        return {
+            'pulls': len(statuses),
+            'queued': statuses.count('queued'),
+            'running': statuses.count('running'),
+            'submitted': self.submitted,
+            'reused': self.reused,
+            'rejected': self.rejected
+        }
+
+
+model_pulls = ModelPullManager(OLLAMA_PULL_WORKERS)
 
 
 # ========== 設置頁面路由 ==========
@@ -1429,8 +4297,7 @@ def get_ollama_models():
         return jsonify({'success': False, 'message': 'Ollama 未啟用'})
     
     try:
-        client = ollama.Client(host=OLLAMA_HOST)
-        models = client.list()
+        models = provider_registry.ollama().list()
         model_list = []
         for model in models.get('models', []):
             model_list.append({
@@ -1445,7 +4312,10 @@ def get_ollama_models():
 
 @app.route('/api/ollama/models/pull', methods=['POST'])
 def pull_ollama_model():
-    """下載 Ollama 模型"""
+    """
+    下載 Ollama 模型：在背景執行並立即返回下載資訊
+    之後以 GET /api/ollama/models/pulls/<id> 輪詢，或訂閱 /api/ollama/models/pulls/<id>/events
+    """
     if not OLLAMA_AVAILABLE:
         return jsonify({'success': False, 'message': 'Ollama 未啟用'})
     
@@ -1455,13 +4325,50 @@ def pull_ollama_model():
     if not model_name:
         return jsonify({'success': False, 'message': '模型名稱不能為空'})
     
-    try:
-        client = ollama.Client(host=OLLAMA_HOST)
-        # 使用 pull 方法下載模型（這是一個同步操作，可能需要時間）
-        client.pull(model_name)
-        return jsonify({'success': True, 'message': f'模型 {model_name} 下載完成'})
-    except Exception as e:
-        return jsonify({'success': False, 'message': f'下載失敗: {str(e)}'})
+    pull, reused = model_pulls.submit(model_name)
+    if pull is None:
+        return jsonify({'success': False, 'message': f'同時進行的下載已達上限（{OLLAMA_PULL_MAX_ACTIVE}），請稍後再試'})
+    message = f'模型 {model_name} 已在下載中' if reused else f'已開始下載模型 {model_name}'
+    return jsonify({'success': True, 'message': message, 'pull': pull.snapshot(), 'reused': reused})
+
+
+@app.route('/api/ollama/models/pulls', methods=['GET'])
+def list_model_pulls():
+    """列出進行中與近期完成的模型下載"""
+    return jsonify({'success': True, 'pulls': model_pulls.list()})
+
+
+@app.route('/api/ollama/models/pulls/<pull_id>', methods=['GET'])
+def get_model_pull(pull_id):
+    """查詢模型下載進度"""
+    pull = model_pulls.get(pull_id)
+    if not pull:
+        return jsonify({'success': False, 'message': '查無此下載'})
+    return jsonify({'success': True, 'pull': pull.snapshot()})
+
+
+@app.route('/api/ollama/models/pulls/<pull_id>/events', methods=['GET'])
+def stream_model_pull(pull_id):
+    """以 Server-Sent Events 推送下載進度（progress），完成或失敗後結束"""
+    pull = model_pulls.get(pull_id)
+    if not pull:
+        return jsonify({'success': False, 'message': '查無此下載'})
+
+    def generate():
+        version = -1
+        while True:
+            current = pull.wait(version, OLLAMA_PULL_SSE_HEARTBEAT)
+            if current == version and not pull.finished:
+                yield ': keep-alive\n\n'
+                continue
+            version = current
+            snapshot = pull.snapshot()
+            event = snapshot['status'] if pull.finished else 'progress'
+            yield f"event: {event}\ndata: {json.dumps(snapshot, ensure_ascii=False)}\n\n"
+            if pull.finished:
+                return
+
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 
 @app.route('/api/ollama/models/delete', methods=['POST'])
@@ -1477,8 +4384,7 @@ def delete_ollama_model():
         return jsonify({'success': False, 'message': '模型名稱不能為空'})
     
     try:
-        client = ollama.Client(host=OLLAMA_HOST)
-        client.delete(model_name)
+        provider_registry.ollama().delete(model_name)
         return jsonify({'success': True, 'message': f'模型 {model_name} 已刪除'})
     except Exception as e:
         return jsonify({'success': False, 'message': f'刪除失敗: {str(e)}'})
@@ -1490,16 +4396,8 @@ def manage_default_model():
     if request.method == 'GET':
         # 從數據庫或配置中讀取默認模型
         try:
-            with closing(get_conn()) as conn:
-                if not DB_IS_PG:
-                    conn.row_factory = sqlite3.Row
-                with closing(conn.cursor(row_factory=dict_row) if DB_IS_PG else conn.cursor()) as cursor:
-                    cursor.execute(q('SELECT config_value FROM app_config WHERE config_key = ?'), ('default_ollama_model',))
-                    row = cursor.fetchone()
-                    if row:
-                        return jsonify({'success': True, 'model': row['config_value'] if DB_IS_PG else row['config_value']})
-                    else:
-                        return jsonify({'success': True, 'model': 'llama2'})  # 默認值
+            # 未設定時使用默認值
+            return jsonify({'success': True, 'model': ConfigRepo.get('default_ollama_model', 'llama2')})
         except Exception as e:
             return jsonify({'success': False, 'message': str(e)})
     
@@ -1512,27 +4410,16 @@ def manage_default_model():
             return jsonify({'success': False, 'message': '模型名稱不能為空'})
         
         try:
-            with closing(get_conn()) as conn:
-                if not DB_IS_PG:
-                    conn.row_factory = sqlite3.Row
-                with closing(conn.cursor(row_factory=dict_row) if DB_IS_PG else conn.cursor()) as cursor:
-                    # 使用 UPSERT 語法
-                    if DB_IS_PG:
-                        cursor.execute(
-                            """
-                            INSERT INTO app_config (config_key, config_value) 
-                            VALUES (%s, %s)
-                            ON CONFLICT (config_key) DO UPDATE SET config_value = EXCLUDED.config_value
-                            """,
-                            ('default_ollama_model', model_name)
-                        )
-                    else:
-                        cursor.execute(
-                            q('INSERT OR REPLACE INTO app_config (config_key, config_value) VALUES (?, ?)'),
-                            ('default_ollama_model', model_name)
-                        )
-                    conn.commit()
-            return jsonify({'success': True, 'message': f'默認模型已設置為 {model_name}'})
+            previous = ConfigRepo.get('default_ollama_model', 'llama2')
+            # 使用 UPSERT 語法
+            ConfigRepo.set('default_ollama_model', model_name)
+            # 背景載入新模型並釋放舊模型佔用的記憶體
+            preloading = OLLAMA_AVAILABLE and OLLAMA_PRELOAD and ollama_warmer.preload(model_name, unload=previous)
+            return jsonify({
+                'success': True,
+                'message': f'默認模型已設置為 {model_name}',
+                'preloading': bool(preloading)
+            })
         except Exception as e:
             return jsonify({'success': False, 'message': str(e)})
 
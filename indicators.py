@@ -0,0 +1,642 @@
+"""
+技術指標計算
+
+- NumPy 向量化 kernel（sma、ema、rsi、macd、bollinger、stochastic、atr）：
+  輸入為 float64 陣列，第 0 軸為時間；傳入 2-D（日期 × 股票）陣列時各欄位獨立計算
+- IndicatorState：每檔股票的指標中間狀態（滾動和、EMA、Wilder 平滑、滾動最大/最小值 deque），
+  新增一根日線時以 O(1)（視窗長度為常數）更新，不必重算整段歷史
+
+兩者語意相同，並與 ta 函式庫一致（min_periods = window、EMA adjust=False），差異僅在：
+- 開頭的 NaN 視為尚未開始（例如批次對齊時尚未上市的股票）
+- 中段缺值不納入 EMA/Wilder 平滑（沿用前值）
+- ATR 暖機期間輸出 NaN（ta 輸出 0）
+
+執行 `python indicators.py` 會與 ta 比對數值並輸出效能測試結果。
+"""
+import copy
+import math
+import time
+from collections import OrderedDict, deque
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+NAN = float('nan')
+
+# 預設指標參數（summary_* 為即時報價摘要所用，沿用 ta 預設值）
+DEFAULT_PARAMS = {
+    'ma': (5, 10, 20, 60),
+    'rsi': (6, 12),
+    'macd': (12, 26, 9),
+    'boll': (20, 2),
+    'kd': (9, 3),
+    'volume_ma': (5, 10),
+    'atr': 14,
+    'summary_rsi': 14,
+    'summary_kd': (14, 3),
+}
+
+
+def _isnan(value):
+    return value is None or value != value
+
+
+class RollingMean:
+    """滾動平均：視窗內任一值為 NaN 時輸出 NaN（同 pandas rolling min_periods=window）"""
+
+    def __init__(self, window):
+        self.window = window
+        self.values = deque()
+        self.total = 0.0
+        self.nans = 0
+
+    def update(self, value):
+        self.values.append(value)
+        if _isnan(value):
+            self.nans += 1
+        else:
+            self.total += value
+        if len(self.values) > self.window:
+            old = self.values.popleft()
+            if _isnan(old):
+                self.nans -= 1
+            else:
+                self.total -= old
+        if len(self.values) < self.window or self.nans:
+            return NAN
+        return self.total / self.window
+
+    def to_dict(self):
+        return {'values': list(self.values), 'total': self.total, 'nans': self.nans}
+
+    def load(self, data):
+        self.values = deque(data['values'])
+        self.total = data['total']
+        self.nans = data['nans']
+
+
+class RollingStd:
+    """滾動母體標準差（ddof=0），直接由視窗內數值計算以避免累加誤差"""
+
+    def __init__(self, window):
+        self.window = window
+        self.values = deque(maxlen=window)
+
+    def update(self, value):
+        self.values.append(value)
+        if len(self.values) < self.window or any(_isnan(v) for v in self.values):
+            return NAN
+        mean = math.fsum(self.values) / self.window
+        return math.sqrt(math.fsum((v - mean) ** 2 for v in self.values) / self.window)
+
+    def to_dict(self):
+        return {'values': list(self.values)}
+
+    def load(self, data):
+        self.values = deque(data['values'], maxlen=self.window)
+
+
+class RollingExtreme:
+    """滾動最大/最小值：單調 deque 保存 (序號, 值)，攤銷 O(1)"""
+
+    def __init__(self, window, mode):
+        self.window = window
+        self.mode = mode
+        self.index = 0
+        self.candidates = deque()
+        self.nan_positions = deque()
+
+    def _dominates(self, a, b):
+        return a >= b if self.mode == 'max' else a <= b
+
+    def update(self, value):
+        i = self.index
+        self.index += 1
+        if _isnan(value):
+            self.nan_positions.append(i)
+        else:
+            while self.candidates and self._dominates(value, self.candidates[-1][1]):
+                self.candidates.pop()
+            self.candidates.append((i, value))
+        start = i - self.window + 1
+        while self.candidates and self.candidates[0][0] < start:
+            self.candidates.popleft()
+        while self.nan_positions and self.nan_positions[0] < start:
+            self.nan_positions.popleft()
+        if self.index < self.window or self.nan_positions or not self.candidates:
+            return NAN
+        return self.candidates[0][1]
+
+    def to_dict(self):
+        return {
+            'index': self.index,
+            'candidates': [list(c) for c in self.candidates],
+            'nan_positions': list(self.nan_positions)
+        }
+
+    def load(self, data):
+        self.index = data['index']
+        self.candidates = deque(tuple(c) for c in data['candidates'])
+        self.nan_positions = deque(data['nan_positions'])
+
+
+class Ema:
+    """
+    指數移動平均（adjust=False）：自第一個非 NaN 值起算，累計 min_periods 個有效值後才輸出
+    NaN 輸入沿用前值（交易資料中不會出現中段缺值）
+    """
+
+    def __init__(self, alpha, min_periods):
+        self.alpha = alpha
+        self.min_periods = min_periods
+        self.value = None
+        self.count = 0
+
+    def update(self, x):
+        if not _isnan(x):
+            self.value = x if self.value is None else self.alpha * x + (1 - self.alpha) * self.value
+            self.count += 1
+        if self.count < self.min_periods or self.value is None:
+            return NAN
+        return self.value
+
+    def to_dict(self):
+        return {'value': self.value, 'count': self.count}
+
+    def load(self, data):
+        self.value = data['value']
+        self.count = data['count']
+
+
+class Rsi:
+    """Wilder RSI（同 ta：首筆漲跌視為 0，alpha = 1/window）"""
+
+    def __init__(self, window):
+        self.up = Ema(1.0 / window, window)
+        self.down = Ema(1.0 / window, window)
+        self.prev_close = None
+
+    def update(self, close):
+        if self.prev_close is None and _isnan(close):
+            return NAN
+        diff = NAN if self.prev_close is None else close - self.prev_close
+        self.prev_close = close
+        gain = diff if diff > 0 else 0.0
+        loss = -diff if diff < 0 else 0.0
+        avg_gain = self.up.update(gain)
+        avg_loss = self.down.update(loss)
+        if _isnan(avg_loss) or _isnan(avg_gain):
+            return NAN
+        if avg_loss == 0:
+            return 100.0
+        return 100.0 - 100.0 / (1.0 + avg_gain / avg_loss)
+
+    def to_dict(self):
+        return {'up': self.up.to_dict(), 'down': self.down.to_dict(), 'prev_close': self.prev_close}
+
+    def load(self, data):
+        self.up.load(data['up'])
+        self.down.load(data['down'])
+        self.prev_close = data['prev_close']
+
+
+class Macd:
+    """MACD：快慢 EMA 差值，訊號線為 MACD 的 EMA（自第一個有效 MACD 起算）"""
+
+    def __init__(self, fast, slow, sign):
+        self.fast = Ema(2.0 / (fast + 1), fast)
+        self.slow = Ema(2.0 / (slow + 1), slow)
+        self.signal = Ema(2.0 / (sign + 1), sign)
+
+    def update(self, close):
+        macd = self.fast.update(close) - self.slow.update(close)
+        signal = self.signal.update(macd)
+        return macd, signal, macd - signal
+
+    def to_dict(self):
+        return {'fast': self.fast.to_dict(), 'slow': self.slow.to_dict(), 'signal': self.signal.to_dict()}
+
+    def load(self, data):
+        self.fast.load(data['fast'])
+        self.slow.load(data['slow'])
+        self.signal.load(data['signal'])
+
+
+class Stochastic:
+    """KD 隨機指標：K = 100 * (收盤 - N 日最低) / (N 日最高 - N 日最低)，D 為 K 的簡單平均"""
+
+    def __init__(self, window, smooth):
+        self.lowest = RollingExtreme(window, 'min')
+        self.highest = RollingExtreme(window, 'max')
+        self.d = RollingMean(smooth)
+
+    def update(self, high, low, close):
+        lowest = self.lowest.update(low)
+        highest = self.highest.update(high)
+        span = highest - lowest
+        if _isnan(span) or _isnan(close):
+            k = NAN
+        elif span == 0:
+            k = NAN if close == lowest else math.copysign(math.inf, close - lowest)
+        else:
+            k = 100.0 * (close - lowest) / span
+        return k, self.d.update(k)
+
+    def to_dict(self):
+        return {'lowest': self.lowest.to_dict(), 'highest': self.highest.to_dict(), 'd': self.d.to_dict()}
+
+    def load(self, data):
+        self.lowest.load(data['lowest'])
+        self.highest.load(data['highest'])
+        self.d.load(data['d'])
+
+
+class Atr:
+    """
+    ATR：前 window 筆有效真實波幅取平均後以 Wilder 平滑，暖機期間輸出 NaN
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.count = 0
+        self.warmup_total = 0.0
+        self.value = NAN
+        self.prev_close = None
+
+    def update(self, high, low, close):
+        ranges = [high - low]
+        if self.prev_close is not None:
+            ranges += [abs(high - self.prev_close), abs(low - self.prev_close)]
+        ranges = [r for r in ranges if not _isnan(r)]
+        self.prev_close = close
+        if ranges:
+            true_range = max(ranges)
+            self.count += 1
+            if self.count < self.window:
+                self.warmup_total += true_range
+            elif self.count == self.window:
+                self.value = (self.warmup_total + true_range) / self.window
+            else:
+                self.value = (self.value * (self.window - 1) + true_range) / self.window
+        return self.value if self.count >= self.window else NAN
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'warmup_total': self.warmup_total,
+            'value': self.value,
+            'prev_close': self.prev_close
+        }
+
+    def load(self, data):
+        self.count = data['count']
+        self.warmup_total = data['warmup_total']
+        self.value = data['value']
+        self.prev_close = data['prev_close']
+
+
+class IndicatorState:
+    """
+    單一股票的指標中間狀態，欄位與 app.compute_indicator_frame 產生的指標欄位相同
+    last_date / last_close 記錄最後一根已納入狀態的日線，用於判斷歷史是否被修正
+    """
+
+    def __init__(self, params):
+        self.params = params
+        self.ma = {w: RollingMean(w) for w in params['ma']}
+        self.rsi = {w: Rsi(w) for w in params['rsi']}
+        self.macd = Macd(*params['macd'])
+        self.boll_mean = RollingMean(params['boll'][0])
+        self.boll_std = RollingStd(params['boll'][0])
+        self.kd = Stochastic(*params['kd'])
+        self.volume_ma = {w: RollingMean(w) for w in params['volume_ma']}
+        self.atr = Atr(params['atr'])
+        self.summary_rsi = Rsi(params['summary_rsi'])
+        self.summary_kd = Stochastic(*params['summary_kd'])
+        self.count = 0
+        self.last_date = None
+        self.last_close = None
+        self.last_values = {}
+
+    def update(self, date, open_, high, low, close, volume):
+        """納入一根日線，返回該日所有指標值"""
+        values = {}
+        for w, ma in self.ma.items():
+            values[f'ma{w}'] = ma.update(close)
+        for w, rsi in self.rsi.items():
+            values[f'rsi{w}'] = rsi.update(close)
+        values['macd'], values['macd_signal'], values['macd_hist'] = self.macd.update(close)
+
+        middle = self.boll_mean.update(close)
+        std = self.boll_std.update(close)
+        dev = self.params['boll'][1]
+        values['boll_upper'] = middle + dev * std
+        values['boll_middle'] = middle
+        values['boll_lower'] = middle - dev * std
+
+        values['kd_k'], values['kd_d'] = self.kd.update(high, low, close)
+        for w, ma in self.volume_ma.items():
+            values[f'volume_ma{w}'] = ma.update(volume)
+        values['atr'] = self.atr.update(high, low, close)
+        values['summary_rsi'] = self.summary_rsi.update(close)
+        values['summary_kd_k'], values['summary_kd_d'] = self.summary_kd.update(high, low, close)
+
+        self.count += 1
+        self.last_date = date
+        self.last_close = close
+        self.last_values = values
+        return values
+
+    def copy(self):
+        return copy.deepcopy(self)
+
+    def _components(self):
+        parts = {'macd': self.macd, 'boll_mean': self.boll_mean, 'boll_std': self.boll_std, 'kd': self.kd,
+                 'atr': self.atr, 'summary_rsi': self.summary_rsi, 'summary_kd': self.summary_kd}
+        parts.update({f'ma{w}': c for w, c in self.ma.items()})
+        parts.update({f'rsi{w}': c for w, c in self.rsi.items()})
+        parts.update({f'volume_ma{w}': c for w, c in self.volume_ma.items()})
+        return parts
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'last_date': self.last_date,
+            'last_close': self.last_close,
+            'last_values': self.last_values,
+            'components': {name: part.to_dict() for name, part in self._components().items()}
+        }
+
+    @classmethod
+    def from_dict(cls, params, data):
+        state = cls(params)
+        state.count = data['count']
+        state.last_date = data['last_date']
+        state.last_close = data['last_close']
+        state.last_values = data['last_values']
+        for name, part in state._components().items():
+            part.load(data['components'][name])
+        return state
+
+
+# ========== NumPy kernel ==========
+# EMA 分塊大小：區塊內以 d^-k 縮放後 cumsum 求解遞迴式，塊長限制縮放倍率避免溢位
+_EMA_BLOCK = 128
+
+
+def _as_2d(values):
+    x = np.asarray(values, dtype=np.float64)
+    return x.reshape(len(x), -1), x.ndim == 1
+
+
+def _restore(out, squeeze):
+    return out[:, 0] if squeeze else out
+
+
+def _rolling(values, window, reducer):
+    """滾動視窗運算：視窗內含 NaN 時結果為 NaN（同 pandas min_periods=window）"""
+    x, squeeze = _as_2d(values)
+    out = np.full(x.shape, np.nan)
+    if len(x) >= window:
+        out[window - 1:] = reducer(sliding_window_view(x, window, axis=0), axis=-1)
+    return _restore(out, squeeze)
+
+
+def sma(values, window):
+    """簡單移動平均"""
+    return _rolling(values, window, np.mean)
+
+
+def rolling_std(values, window):
+    """滾動母體標準差（ddof=0）"""
+    return _rolling(values, window, np.std)
+
+
+def rolling_min(values, window):
+    return _rolling(values, window, np.min)
+
+
+def rolling_max(values, window):
+    return _rolling(values, window, np.max)
+
+
+def _ema_dense(x, alpha):
+    """無缺值的 2-D 陣列沿第 0 軸計算 EMA（adjust=False，y0 = x0）"""
+    out = np.empty_like(x)
+    if len(x) == 0:
+        return out
+    if alpha >= 1:
+        out[:] = x
+        return out
+    decay = 1.0 - alpha
+    steps = np.arange(_EMA_BLOCK)
+    prev = x[0].copy()
+    for start in range(0, len(x), _EMA_BLOCK):
+        chunk = x[start:start + _EMA_BLOCK]
+        k = steps[:len(chunk), None]
+        # y[j] = d^(j+1) * prev + a * d^j * Σ_{i<=j} x[i] * d^-i
+        acc = np.cumsum(chunk * decay ** -k, axis=0)
+        y = decay ** k * (decay * prev + alpha * acc)
+        out[start:start + len(chunk)] = y
+        prev = y[-1]
+    return out
+
+
+def ema(values, alpha, min_periods):
+    """
+    指數移動平均（adjust=False）：各欄位自第一個有效值起算，累計 min_periods 個有效值後才輸出；
+    中段 NaN 不納入計算，輸出沿用前值
+    """
+    x, squeeze = _as_2d(values)
+    out = np.full(x.shape, np.nan)
+    valid = ~np.isnan(x)
+    counts = np.cumsum(valid, axis=0)
+    if len(x) == 0:
+        return _restore(out, squeeze)
+
+    first = valid.argmax(axis=0)
+    started = valid.any(axis=0)
+    # 只有開頭缺值的欄位：以第一個有效值回填後整批計算（回填部分輸出恆等於該值，之後遮罩）
+    dense = started & (counts[-1] == len(x) - first)
+    if dense.any():
+        block = x[:, dense].copy()
+        rows = np.arange(len(x))[:, None]
+        block = np.where(rows < first[dense], block[first[dense], np.arange(block.shape[1])], block)
+        out[:, dense] = _ema_dense(block, alpha)
+    # 中段有缺值的欄位：只以有效值計算後向前填補
+    for col in np.flatnonzero(started & ~dense):
+        idx = np.flatnonzero(valid[:, col])
+        series = np.full(len(x), np.nan)
+        series[idx] = _ema_dense(x[idx, col][:, None], alpha)[:, 0]
+        filled_idx = np.maximum.accumulate(np.where(np.isnan(series), 0, np.arange(len(x))))
+        out[:, col] = series[filled_idx]
+
+    out[counts < max(min_periods, 1)] = np.nan
+    return _restore(out, squeeze)
+
+
+def _leading(values):
+    """第一個有效值之前的位置"""
+    return np.cumsum(~np.isnan(values), axis=0) == 0
+
+
+def rsi(close, window):
+    """Wilder RSI：首筆漲跌視為 0，平均漲跌以 alpha = 1/window 平滑"""
+    close = np.asarray(close, dtype=np.float64)
+    diff = np.full(close.shape, np.nan)
+    diff[1:] = close[1:] - close[:-1]
+    with np.errstate(invalid='ignore'):
+        gain = np.where(diff > 0, diff, 0.0)
+        loss = np.where(diff < 0, -diff, 0.0)
+    leading = _leading(close)
+    gain[leading] = np.nan
+    loss[leading] = np.nan
+    avg_gain = ema(gain, 1.0 / window, window)
+    avg_loss = ema(loss, 1.0 / window, window)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out = np.where(avg_loss == 0, 100.0, 100.0 - 100.0 / (1.0 + avg_gain / avg_loss))
+    out[np.isnan(avg_loss) | np.isnan(avg_gain)] = np.nan
+    return out
+
+
+def macd(close, fast=12, slow=26, sign=9):
+    """返回 (macd, signal, hist)"""
+    line = ema(close, 2.0 / (fast + 1), fast) - ema(close, 2.0 / (slow + 1), slow)
+    signal = ema(line, 2.0 / (sign + 1), sign)
+    return line, signal, line - signal
+
+
+def bollinger(close, window=20, dev=2):
+    """返回 (upper, middle, lower)"""
+    middle = sma(close, window)
+    std = rolling_std(close, window)
+    return middle + dev * std, middle, middle - dev * std
+
+
+def stochastic(high, low, close, window=14, smooth=3):
+    """返回 (K, D)"""
+    lowest = rolling_min(low, window)
+    highest = rolling_max(high, window)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        k = 100.0 * (np.asarray(close, dtype=np.float64) - lowest) / (highest - lowest)
+    return k, sma(k, smooth)
+
+
+def atr(high, low, close, window=14):
+    """ATR：前 window 筆有效真實波幅的平均作為起點，之後以 Wilder 平滑"""
+    high = np.asarray(high, dtype=np.float64)
+    low = np.asarray(low, dtype=np.float64)
+    close = np.asarray(close, dtype=np.float64)
+    prev_close = np.full(close.shape, np.nan)
+    prev_close[1:] = close[:-1]
+    true_range = np.fmax(high - low, np.fmax(np.abs(high - prev_close), np.abs(low - prev_close)))
+
+    x, squeeze = _as_2d(true_range)
+    valid = ~np.isnan(x)
+    counts = np.cumsum(valid, axis=0)
+    totals = np.cumsum(np.where(valid, x, 0.0), axis=0)
+    seeded = np.where(valid & (counts > window), x, np.nan)
+    cols = np.flatnonzero(counts[-1] >= window) if len(x) else np.array([], dtype=int)
+    seed_rows = (counts[:, cols] >= window).argmax(axis=0)
+    seeded[seed_rows, cols] = totals[seed_rows, cols] / window
+    return _restore(ema(seeded, 1.0 / window, 1), squeeze)
+
+
+def compute_indicators(open_, high, low, close, volume, params):
+    """
+    一次計算所有指標欄位（欄位名稱與 IndicatorState.update 相同），返回 {欄位: 陣列}
+    """
+    columns = OrderedDict()
+    for w in params['ma']:
+        columns[f'ma{w}'] = sma(close, w)
+    for w in params['rsi']:
+        columns[f'rsi{w}'] = rsi(close, w)
+    columns['macd'], columns['macd_signal'], columns['macd_hist'] = macd(close, *params['macd'])
+    columns['boll_upper'], columns['boll_middle'], columns['boll_lower'] = bollinger(close, *params['boll'])
+    columns['kd_k'], columns['kd_d'] = stochastic(high, low, close, *params['kd'])
+    for w in params['volume_ma']:
+        columns[f'volume_ma{w}'] = sma(volume, w)
+    columns['atr'] = atr(high, low, close, params['atr'])
+    columns['summary_rsi'] = rsi(close, params['summary_rsi'])
+    columns['summary_kd_k'], columns['summary_kd_d'] = stochastic(high, low, close, *params['summary_kd'])
+    return columns
+
+
+# ========== 與 ta 比對及效能測試 ==========
+def _ta_reference(bars, params):
+    """以 ta 函式庫計算同一組指標（原 app.py 實作），作為數值比對與效能基準"""
+    import pandas as pd
+    import ta
+
+    close, high, low = bars['close'], bars['high'], bars['low']
+    out = {}
+    for w in params['ma']:
+        out[f'ma{w}'] = ta.trend.sma_indicator(close, window=w)
+    for w in params['rsi']:
+        out[f'rsi{w}'] = ta.momentum.rsi(close, window=w)
+    fast, slow, sign = params['macd']
+    indicator = ta.trend.MACD(close, window_slow=slow, window_fast=fast, window_sign=sign)
+    out['macd'], out['macd_signal'], out['macd_hist'] = indicator.macd(), indicator.macd_signal(), indicator.macd_diff()
+    indicator = ta.volatility.BollingerBands(close, window=params['boll'][0], window_dev=params['boll'][1])
+    out['boll_upper'] = indicator.bollinger_hband()
+    out['boll_middle'] = indicator.bollinger_mavg()
+    out['boll_lower'] = indicator.bollinger_lband()
+    indicator = ta.momentum.StochasticOscillator(high, low, close, window=params['kd'][0], smooth_window=params['kd'][1])
+    out['kd_k'], out['kd_d'] = indicator.stoch(), indicator.stoch_signal()
+    for w in params['volume_ma']:
+        out[f'volume_ma{w}'] = ta.trend.sma_indicator(bars['volume'], window=w)
+    out['atr'] = ta.volatility.average_true_range(high, low, close, window=params['atr'])
+    out['summary_rsi'] = ta.momentum.rsi(close, window=params['summary_rsi'])
+    window, smooth = params['summary_kd']
+    indicator = ta.momentum.StochasticOscillator(high, low, close, window=window, smooth_window=smooth)
+    out['summary_kd_k'], out['summary_kd_d'] = indicator.stoch(), indicator.stoch_signal()
+    return pd.DataFrame(out)
+
+
+def _synthetic_bars(n, seed=0):
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    close = 500 + np.cumsum(rng.normal(0, 5, n))
+    high = close + rng.random(n) * 5
+    low = close - rng.random(n) * 5
+    return pd.DataFrame({'open': close, 'high': high, 'low': low, 'close': close,
+                         'volume': rng.random(n) * 1e7})
+
+
+def _best_of(func, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+
+def main():
+    params = DEFAULT_PARAMS
+    print('數值比對（NumPy kernel vs ta，5 年 = 1,260 根日線）')
+    bars = _synthetic_bars(1260)
+    ours = compute_indicators(*(bars[c].to_numpy() for c in ('open', 'high', 'low', 'close', 'volume')), params)
+    reference = _ta_reference(bars, params)
+    for name, values in ours.items():
+        expected = reference[name].to_numpy(dtype=np.float64)
+        if name == 'atr':
+            # ta 暖機期間輸出 0，此處輸出 NaN
+            expected = expected.copy()
+            expected[:params['atr'] - 1] = np.nan
+        assert np.array_equal(np.isnan(values), np.isnan(expected)), name
+        print(f'  {name:<14} max |diff| = {np.nanmax(np.abs(values - expected)):.2e}')
+
+    print('\n每檔股票計算耗時（ms，取 5 次最佳）')
+    print(f'  {"年數":<6}{"日線數":>8}{"numpy":>10}{"ta":>10}')
+    for years in (1, 5, 20):
+        bars = _synthetic_bars(252 * years)
+        arrays = [bars[c].to_numpy() for c in ('open', 'high', 'low', 'close', 'volume')]
+        ours_ms = _best_of(lambda: compute_indicators(*arrays, params))
+        ta_ms = _best_of(lambda: _ta_reference(bars, params))
+        print(f'  {years:<6}{len(bars):>8}{ours_ms:>10.2f}{ta_ms:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()